@@ -1,20 +1,91 @@
+import json
 import os
-import sys
+import time
 import aiofiles
-import httpx
+import aiofiles.os
 import asyncio
-import platform
-import subprocess
-from bilibili_api import video, Credential
-from bilibili_api.video import VideoDownloadURLDataDetecter
+from functools import partial
+from typing import Awaitable, Callable, Hashable
 from astrbot import logger
-import shutil
+from .client import HttpClient
+from .cache import SingleFlight, TTLCache
+from .store import VideoStore
+from .downloader import SegmentedDownloader
+from .muxer import (
+    InterleavePlan,
+    MuxError,
+    finish_interleave,
+    merge_streams,
+    parse_segment_index,
+    plan_interleave,
+)
+from .streams import StreamChoice, select_streams
+from .scheduler import DownloadScheduler
+from .governor import ApiError, RequestGovernor
+from .metrics import metrics
+from .models import VideoItem, parse_results
+
+# 下载进度日志的最小间隔（秒）
+PROGRESS_LOG_INTERVAL = 5.0
+
+# 解析出的下载链接的缓存时间（秒），B站的流地址约两小时后失效
+STREAM_URL_TTL = 600
+
+# 下载链接解析函数：(bvid, 画质上限, 时长, 预览秒数) -> 选中的音视频流
+StreamResolver = Callable[[str, int | None, int, int], Awaitable[StreamChoice | None]]
 
 class VideoAPI():
     """
     视频API类
     """
-    def __init__(self, cookie: str):
+    def __init__(
+        self,
+        cookie: str,
+        client: HttpClient,
+        search_cache_size: int = 256,
+        search_cache_ttl: float = 300,
+        store: VideoStore | None = None,
+        download_segments: int = 4,
+        size_budget: int = 0,
+        scheduler: DownloadScheduler | None = None,
+        preresolve_concurrency: int = 2,
+        prewarm_bytes: int = 0,
+        governor: RequestGovernor | None = None,
+        resolver: StreamResolver | None = None,
+    ):
+        self.client = client
+        # 下载链接解析函数，默认请求B站接口，测试和压测可以换成返回本地流的函数
+        self.resolver: StreamResolver = resolver or self._resolve_streams
+        # B站接口请求的限速、重试和熔断
+        self.governor = governor or RequestGovernor()
+        # 下载调度器，限制同时进行的下载数和总带宽
+        self.scheduler = scheduler or DownloadScheduler()
+        # 下载体积预算（字节），选流时挑放得下的最佳音视频组合，0 表示总是选最佳画质
+        self.size_budget = size_budget
+        # 分段下载器，与搜索共用连接池
+        self.downloader = SegmentedDownloader(
+            client, segments=download_segments, limiter=self.scheduler.limiter
+        )
+        # 视频库，为 None 时不保存视频
+        self.store = store
+        # 搜索结果缓存，键为 (规范化关键词, 页码)
+        self.search_cache = TTLCache(search_cache_size, search_cache_ttl)
+        # 正在进行的搜索请求，避免预取和用户翻页重复请求
+        self._search_flight = SingleFlight()
+        # 正在进行的下载，键为 (bvid, 画质)，多个群同时点同一个视频只下载一次
+        self._download_flight = SingleFlight()
+        # 已解析的下载链接，键为 (bvid, 画质, 预览秒数)，用户选中预解析过的视频时省去一次接口请求
+        self.stream_cache = TTLCache(256, STREAM_URL_TTL)
+        # 正在进行的链接解析，下载可以直接等待进行中的预解析
+        self._resolve_flight = SingleFlight()
+        # 正在进行的解析中属于预解析的键
+        self._speculating: set[tuple[str, int | None, int]] = set()
+        # 同时进行的预解析数上限，避免一次搜索触发过多接口请求
+        self._preresolve_semaphore = asyncio.Semaphore(preresolve_concurrency)
+        # 预解析后预先请求的流头部字节数，0 表示不预热
+        self.prewarm_bytes = prewarm_bytes
+        # 后台任务（预取、预解析），持有引用防止被回收
+        self._background_tasks: set[asyncio.Task] = set()
         self.BILIBILI_SEARCH_API = "https://api.bilibili.com/x/web-interface/search/type"
 
         self.BILIBILI_HEADER = {
@@ -25,144 +96,643 @@ class VideoAPI():
             "Cookie": cookie,
         }
 
-    async def search_video(self, keyword: str,  page: int = 1) -> list[dict] | None:
+    @staticmethod
+    def _normalize_keyword(keyword: str) -> str:
+        """规范化关键词：去除多余空白并转小写"""
+        return " ".join(keyword.split()).lower()
+
+    async def search_video(self, keyword: str,  page: int = 1) -> list[VideoItem] | None:
         """
-        搜索视频
+        搜索视频，优先使用缓存。没有结果时返回空列表，接口不可用且没有旧结果时返回 None
         """
+        key = (self._normalize_keyword(keyword), page)
+        cached = self.search_cache.get(key)
+        if cached is not None:
+            return cached
+        return await self._search_flight.do(key, lambda: self._fetch_search(*key))
+
+    def prefetch_search(self, keyword: str, page: int):
+        """在后台预取指定页的搜索结果"""
+        if self.search_cache.ttl == 0:
+            # 缓存时间为 0 时预取的结果立即过期，用户翻页时仍会重新请求，预取只会多一次请求
+            return
+        key = (self._normalize_keyword(keyword), page)
+        if key in self.search_cache or key in self._search_flight:
+            return
+        task = self._search_flight.task(key, lambda: self._fetch_search(*key))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _fetch_search(self, keyword: str, page: int) -> list[VideoItem] | None:
+        """
+        经请求管控调用B站搜索接口，成功的结果写入缓存。
+        请求失败或熔断时改用已过期的缓存结果，都没有时返回 None
+        """
+        key = (keyword, page)
+        try:
+            with metrics.timer("search"):
+                video_list = await self.governor.call(
+                    "search", lambda: self._request_search(keyword, page)
+                )
+        except Exception as e:
+            stale = self.search_cache.get_stale(key)
+            if stale is not None:
+                logger.warning(f"搜索失败（{e}），使用过期的缓存结果")
+                metrics.error("search_stale")
+                return stale
+            logger.error(f"搜索失败: {e}")
+            return None
+        if video_list:
+            self.search_cache.set(key, video_list)
+        return video_list
+
+    async def _request_search(self, keyword: str, page: int) -> list[VideoItem]:
+        """请求一次搜索接口，结果解析为 VideoItem"""
         params = {"search_type": "video", "keyword": keyword, "page": page}
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    self.BILIBILI_SEARCH_API, params=params, headers=self.BILIBILI_HEADER
+        response = await self.client.get(
+            self.BILIBILI_SEARCH_API, params=params, headers=self.BILIBILI_HEADER
+        )
+        response.raise_for_status()
+        data = response.json()
+        if data["code"] != 0:
+            raise ApiError(data["code"], data.get("message", ""))
+        results = data["data"].get("result", [])
+        logger.debug(results)
+        return parse_results(results)
+
+    def search_stats(self) -> dict:
+        """搜索缓存的命中统计"""
+        return self.search_cache.stats()
+
+    def stream_stats(self) -> dict:
+        """下载链接缓存的命中统计"""
+        return self.stream_cache.stats()
+
+    def preresolve(
+        self, videos: list[VideoItem], quality: int | None = None
+    ) -> dict[str, asyncio.Task]:
+        """
+        在用户选择期间后台解析这些视频的下载链接，选中后可以立即开始下载。
+        同时进行的解析数受 preresolve_concurrency 限制，已在视频库中的视频跳过。
+        返回以 bvid 为键的任务，由调用方取消没被选中的视频的预解析
+        """
+        tasks = {}
+        for video in videos:
+            task = asyncio.create_task(self._speculate(video, quality))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+            tasks[video.bvid] = task
+        return tasks
+
+    async def _speculate(self, video: VideoItem, quality: int | None):
+        """预解析一个视频的下载链接，按配置预热音视频流的头部"""
+        key = (video.bvid, quality, 0)
+        if key in self.stream_cache:
+            return
+        label = self._label(quality)
+        if self.store is not None and await aiofiles.os.path.exists(
+            self.store.path_for(video.bvid, label)
+        ):
+            return
+        try:
+            # 先排队再加入解析，用户选中还在排队的视频时，下载会直接发起自己的解析
+            async with self._preresolve_semaphore:
+                choice = await self.resolve_streams(
+                    video.bvid, quality, video.duration, speculative=True
+                )
+            if choice is not None and self.prewarm_bytes:
+                await asyncio.gather(
+                    self.downloader.warm(choice.video.url, self.BILIBILI_HEADER, self.prewarm_bytes),
+                    self.downloader.warm(choice.audio.url, self.BILIBILI_HEADER, self.prewarm_bytes),
                 )
-                response.raise_for_status()
-                data = response.json()
+        except Exception as e:
+            logger.debug(f"预解析 {video.bvid} 失败: {e}")
 
-                if data["code"] == 0:
-                    video_list = data["data"].get("result", [])
-                    logger.debug(video_list)
-                    return video_list
+    async def close(self):
+        """
+        取消并等待后台任务和进行中的下载、解析、搜索，再关闭视频库。
+        插件重载后旧实例不会再写入临时文件，避免和新实例的同名下载互相覆盖
+        """
+        tasks = list(self._background_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._download_flight.cancel_all()
+        await self._resolve_flight.cancel_all()
+        await self._search_flight.cancel_all()
+        if self.store is not None:
+            await self.store.close()
 
-            except Exception as e:
-                logger.error(f"发生错误: {e}")
-                return []
+    async def download_video(
+        self,
+        video_id: str,
+        temp_dir: str,
+        quality: int | None = None,
+        duration: int = 0,
+        group: Hashable = None,
+        notify: Callable[[int], Awaitable] | None = None,
+    ) -> str | None:
+        """
+        下载视频，quality 为最高画质代码（None 表示最佳画质），duration 为视频时长（秒），
+        用于按体积预算选流。已下载完成的视频直接返回，同一视频同一画质的并发请求共用一次下载。
+        新的下载经调度器排队，group 为发起下载的群/会话，需要排队时调用 notify(前面的任务数)，
+        队列已满时抛出 QueueFull
+        """
+        label = self._label(quality)
+        output_file = os.path.join(temp_dir, f"{video_id}-{label}.mp4")
+        return await self._fetch_video(
+            video_id,
+            label,
+            output_file,
+            group,
+            notify,
+            lambda: self._download_video(
+                video_id, temp_dir, quality, output_file, label, duration
+            ),
+        )
 
-    async def download_video(self, video_id: str, temp_dir: str) -> str | None:
-        """下载视频"""
-        # 确保临时目录存在
-        os.makedirs(temp_dir, exist_ok=True)
+    async def download_preview(
+        self,
+        video_id: str,
+        temp_dir: str,
+        seconds: int,
+        quality: int | None = None,
+        group: Hashable = None,
+        notify: Callable[[int], Awaitable] | None = None,
+    ) -> str | None:
+        """
+        下载视频开头约 seconds 秒的预览片段，用于超过时长上限的视频：
+        按 DASH 的 sidx 分段索引只请求覆盖这段时间的字节区间，再合并为可直接播放的短视频。
+        缓存、排队和并发合并与 download_video 相同
+        """
+        label = f"{self._label(quality)}P{seconds}"
+        output_file = os.path.join(temp_dir, f"{video_id}-{label}.mp4")
+        return await self._fetch_video(
+            video_id,
+            label,
+            output_file,
+            group,
+            notify,
+            lambda: self._download_preview(
+                video_id, temp_dir, quality, seconds, output_file, label
+            ),
+        )
+
+    async def _fetch_video(
+        self,
+        video_id: str,
+        label: str,
+        output_file: str,
+        group: Hashable,
+        notify: Callable[[int], Awaitable] | None,
+        job: Callable[[], Awaitable[str | None]],
+    ) -> str | None:
+        """优先使用视频库和已下载的文件，否则经调度器排队执行 job，同一视频同一标签只执行一次"""
+        if self.store is not None:
+            stored = await self.store.lookup(video_id, label)
+            if stored:
+                logger.info(f"使用视频库中的视频：{stored}")
+                return stored
+        # 成品文件是原子提交的，存在即完整
+        if (
+            await aiofiles.os.path.exists(output_file)
+            and await aiofiles.os.path.getsize(output_file) > 0
+        ):
+            logger.info(f"使用已下载的视频：{output_file}")
+            return output_file
+
+        return await self._download_flight.do(
+            (video_id, label), lambda: self._scheduled(group, notify, job)
+        )
 
+    def _label(self, quality: int | None) -> str:
+        """成品文件和视频库使用的画质标签"""
+        label = str(quality) if quality else "best"
+        if self.size_budget:
+            # 不同预算选出的流不同，预算也是缓存键的一部分，如 bestL100 表示 100MB 以内的最佳画质
+            label += f"L{self.size_budget // (1024 * 1024)}"
+        return label
+
+    async def _scheduled(
+        self,
+        group: Hashable,
+        notify: Callable[[int], Awaitable] | None,
+        job: Callable[[], Awaitable[str | None]],
+    ) -> str | None:
+        async with self.scheduler.slot(group, notify):
+            return await job()
+
+    async def _download_video(
+        self,
+        video_id: str,
+        temp_dir: str,
+        quality: int | None,
+        output_file: str,
+        label: str,
+        duration: int,
+    ) -> str | None:
         # 获取视频流和音频流下载链接
-        v = video.Video(video_id, credential=Credential(sessdata=""))
-        download_url_data = await v.get_download_url(page_index=0)
-        detector = VideoDownloadURLDataDetecter(download_url_data)
-        streams = detector.detect_best_streams()
-        video_url, audio_url = streams[0].url, streams[1].url
+        choice = await self._choose_streams(video_id, quality, duration)
+        if choice is None:
+            return None
+        try:
+            return await self._download_interleaved(
+                choice, temp_dir, video_id, label, output_file, duration
+            )
+        except MuxError as e:
+            logger.warning(f"无法直接写出合并结果（{e}），改为先下载再合并")
+        return await self._download_streams(
+            choice,
+            temp_dir,
+            video_id,
+            label,
+            output_file,
+            duration,
+            lambda stream, path: self._download_b_file(stream.url, path),
+        )
+
+    async def _download_preview(
+        self,
+        video_id: str,
+        temp_dir: str,
+        quality: int | None,
+        seconds: int,
+        output_file: str,
+        label: str,
+    ) -> str | None:
+        choice = await self._choose_streams(video_id, quality, seconds, clip_seconds=seconds)
+        if choice is None:
+            return None
+        try:
+            return await self._download_interleaved(
+                choice, temp_dir, video_id, label, output_file, seconds, seconds
+            )
+        except MuxError as e:
+            logger.warning(f"无法直接写出合并结果（{e}），改为先下载再合并")
+        return await self._download_streams(
+            choice,
+            temp_dir,
+            video_id,
+            label,
+            output_file,
+            seconds,
+            lambda stream, path: self._download_clip(stream, path, seconds),
+            partial=True,
+        )
 
-        # 构建文件路径
-        video_file = os.path.join(temp_dir, f"{video_id}-video.m4s")
-        audio_file = os.path.join(temp_dir, f"{video_id}-audio.m4s")
-        output_file = os.path.join(temp_dir, f"{video_id}-res.mp4")
+    async def _download_interleaved(
+        self,
+        choice: StreamChoice,
+        temp_dir: str,
+        video_id: str,
+        label: str,
+        output_file: str,
+        duration: int,
+        seconds: int = 0,
+    ) -> str | None:
+        """
+        把音视频流直接下载成合并好的文件，每个字节只写一次：先取两条流的初始化段和 sidx，
+        规划交错后的布局并写入合并的文件头，再把各子分段按源偏移写到输出中的位置，
+        最后就地改写 moof 的序号和轨道号。seconds 不为 0 时只下载开头这么多秒。
+        流没有分段索引或结构不支持时抛出 MuxError，由调用方改为先下载再合并；
+        下载失败时保留 .part 和进度文件供续传，返回 None
+        """
+        streams = (choice.video, choice.audio)
+        index_ends = []
+        for stream in streams:
+            index_range = getattr(stream, "segment_base_index_range", "")
+            if not index_range:
+                raise MuxError("流没有分段索引")
+            index_ends.append(int(index_range.split("-")[1]))
 
-        # 下载视频和音频
+        await aiofiles.os.makedirs(temp_dir, exist_ok=True)
+        # 同一视频同一标签同时只有一个任务（见 _fetch_video），按 (bvid, 标签) 命名不会冲突
+        part_file = os.path.join(temp_dir, f"{video_id}-{label}-merged.mp4.part")
+        state_file = part_file + ".state"
+        start = time.monotonic()
         try:
-            await asyncio.gather(
-                self._download_b_file(video_url, video_file),
-                self._download_b_file(audio_url, audio_file),
+            heads = await _run_together(
+                self.downloader.read_range(stream.url, 0, end, self.BILIBILI_HEADER)
+                for stream, end in zip(streams, index_ends)
             )
         except Exception as e:
-            logger.error(f"视频/音频下载失败: {e}")
+            logger.error(f"获取音视频流头部失败: {e}")
             return None
+        plan = plan_interleave(heads[0], heads[1], seconds)
 
-        # 合并视频和音频
+        segments = [self.downloader.scatter_plan(extents) for extents in plan.extents]
+        if not await self._resume_interleaved(part_file, state_file, plan, segments):
+            async with aiofiles.open(part_file, "wb") as f:
+                # 预分配输出文件，各段直接写入自己的位置
+                await f.truncate(plan.size)
+                await f.write(plan.header)
+
+        name = os.path.basename(output_file)
         try:
-            await self._merge_file_to_mp4(video_file, audio_file, output_file)
-        except Exception as merge_err:
-            logger.warning(f"合并视频音频失败，回退为仅视频：{merge_err}")
-            shutil.copy(video_file, output_file)
-
-        # 删除临时文件
-        for f in [video_file, audio_file]:
-            if os.path.exists(f):
-                os.remove(f)
-
-        if not os.path.exists(output_file):
-            logger.error(f"输出文件不存在：{output_file}")
+            with metrics.timer("download"):
+                await _run_together(
+                    self.downloader.download_scattered(
+                        stream.url,
+                        part_file,
+                        extents,
+                        segment_plan,
+                        self.BILIBILI_HEADER,
+                        self._progress_logger(f"{name}（{kind}）"),
+                    )
+                    for stream, extents, segment_plan, kind in zip(
+                        streams, plan.extents, segments, ("视频", "音频")
+                    )
+                )
+        except BaseException as e:
+            async with aiofiles.open(state_file, "w") as f:
+                await f.write(
+                    json.dumps(
+                        {
+                            "size": plan.size,
+                            "header": plan.header.hex(),
+                            "done": [segment_plan.done for segment_plan in segments],
+                        }
+                    )
+                )
+            if not isinstance(e, Exception):
+                raise
+            logger.error(f"视频/音频下载失败: {e}")
             return None
 
-        return output_file
+        try:
+            with metrics.timer("merge"):
+                await asyncio.to_thread(finish_interleave, part_file, plan)
+        except (MuxError, OSError) as e:
+            for f in [part_file, state_file]:
+                if await aiofiles.os.path.exists(f):
+                    await aiofiles.os.remove(f)
+            raise MuxError(f"改写分片失败：{e}") from e
 
-    async def _download_b_file(
-        self, url: str, full_file_name: str
-    ):
-        async with httpx.AsyncClient() as client:
-            async with client.stream("GET", url, headers=self.BILIBILI_HEADER) as resp:
-                current_len = 0
-                total_len = int(resp.headers.get("content-length", 0))
-                last_percent = -1
+        await aiofiles.os.replace(part_file, output_file)
+        if await aiofiles.os.path.exists(state_file):
+            await aiofiles.os.remove(state_file)
+        elapsed = time.monotonic() - start
+        metrics.observe_download(plan.size, elapsed)
+        logger.info(
+            f"下载完成 {name}: {plan.duration:.0f}秒，{plan.size / 1024 / 1024:.1f}MB，"
+            f"用时 {elapsed:.1f}秒"
+        )
+        if self.store is not None:
+            await self.store.add(video_id, label, output_file, duration)
+        return output_file
 
-                async with aiofiles.open(full_file_name, "wb") as f:
-                    async for chunk in resp.aiter_bytes():
-                        current_len += len(chunk)
-                        await f.write(chunk)
+    async def _resume_interleaved(
+        self, part_file: str, state_file: str, plan: InterleavePlan, segments: list
+    ) -> bool:
+        """读取上次中断时保存的进度，布局相同且文件完整时恢复到 segments 中并返回 True"""
+        try:
+            async with aiofiles.open(state_file) as f:
+                state = json.loads(await f.read())
+            if (
+                state["size"] != plan.size
+                or state["header"] != plan.header.hex()
+                or await aiofiles.os.path.getsize(part_file) != plan.size
+                or [len(done) for done in state["done"]]
+                != [len(segment_plan.ranges) for segment_plan in segments]
+            ):
+                return False
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        for segment_plan, done in zip(segments, state["done"]):
+            segment_plan.done = [int(n) for n in done]
+        logger.info(
+            f"续传 {os.path.basename(part_file)}，已完成 "
+            f"{sum(sum(segment_plan.done) for segment_plan in segments)}/{plan.size} 字节"
+        )
+        return True
 
-                        percent = int(current_len / total_len * 100)
-                        if percent != last_percent:
-                            last_percent = percent
-                            self._print_progress_bar(percent, full_file_name)
-                # 下载完成后换行
-                sys.stdout.write("\n")
-                sys.stdout.flush()
+    async def _download_streams(
+        self,
+        choice: StreamChoice,
+        temp_dir: str,
+        video_id: str,
+        label: str,
+        output_file: str,
+        duration: int,
+        fetch: Callable[[object, str], Awaitable],
+        partial: bool = False,
+    ) -> str | None:
+        """用 fetch(流, 路径) 下载选中的音视频流，合并后原子提交为 output_file 并登记到视频库"""
+        # 确保临时目录存在
+        await aiofiles.os.makedirs(temp_dir, exist_ok=True)
 
+        # 构建文件路径。同一视频同一画质同时只有一个任务（见 _fetch_video），
+        # 所以临时文件按 (bvid, 画质) 命名即不会冲突，失败后的 .part 文件可供下次续传
+        video_file = os.path.join(temp_dir, f"{video_id}-{label}-video.m4s")
+        audio_file = os.path.join(temp_dir, f"{video_id}-{label}-audio.m4s")
+        merged_file = os.path.join(temp_dir, f"{video_id}-{label}-merged.mp4")
 
-    def _print_progress_bar(self, percent: int, label: str = ""):
-        bar_length = 50
-        filled_length = int(bar_length * percent // 100)
-        bar = "█" * filled_length + "-" * (bar_length - filled_length)
+        try:
+            # 下载视频和音频
+            try:
+                with metrics.timer("download"):
+                    await _run_together(
+                        [fetch(choice.video, video_file), fetch(choice.audio, audio_file)]
+                    )
+            except Exception as e:
+                logger.error(f"视频/音频下载失败: {e}")
+                return None
 
-        # 提取文件名并限制长度，避免刷屏
-        file_name = os.path.basename(label)
-        if len(file_name) > 30:
-            file_name = "..." + file_name[-27:]
+            # 合并视频和音频
+            try:
+                with metrics.timer("merge"):
+                    await merge_streams(video_file, audio_file, merged_file, partial)
+            except (MuxError, OSError) as e:
+                logger.error(f"合并视频音频失败: {e}")
+                return None
 
-        sys.stdout.write(f"\r{file_name:<30} [{bar}] {percent:3d}%")
-        sys.stdout.flush()
+            # 原子提交成品文件
+            await aiofiles.os.replace(merged_file, output_file)
+            if self.store is not None:
+                await self.store.add(video_id, label, output_file, duration)
+            return output_file
+        finally:
+            # 删除临时文件
+            for f in [video_file, audio_file, merged_file]:
+                if await aiofiles.os.path.exists(f):
+                    await aiofiles.os.remove(f)
 
+    async def _choose_streams(
+        self, video_id: str, quality: int | None, duration: int, clip_seconds: int = 0
+    ) -> StreamChoice | None:
+        """下载前解析下载链接并计时，接口出错或熔断时记录日志并返回 None"""
+        try:
+            with metrics.timer("url_resolve"):
+                return await self.resolve_streams(video_id, quality, duration, clip_seconds)
+        except Exception as e:
+            logger.error(f"获取 {video_id} 的下载链接失败: {e}")
+            return None
 
-    async def _merge_file_to_mp4(
+    async def resolve_streams(
         self,
-        v_full_file_name: str,
-        a_full_file_name: str,
-        output_file_name: str,
-        log_output: bool = False,
-    ) -> None:
-        """
-        合并视频文件和音频文件
-        :param v_full_file_name: 视频文件路径
-        :param a_full_file_name: 音频文件路径
-        :param output_file_name: 输出文件路径
-        :param log_output: 是否显示 ffmpeg 输出日志，默认忽略
-        :return:
-        """
-        logger.info(f"正在合并：{output_file_name}")
-
-        # 构建 ffmpeg 命令
-        command = f'ffmpeg -y -i "{v_full_file_name}" -i "{a_full_file_name}" -c copy "{output_file_name}"'
-        stdout = None if log_output else subprocess.DEVNULL
-        stderr = None if log_output else subprocess.DEVNULL
-
-        if platform.system() == "Windows":
-            # Windows 下使用 run_in_executor
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: subprocess.call(command, shell=True, stdout=stdout, stderr=stderr),  # noqa: ASYNC221
+        video_id: str,
+        quality: int | None,
+        duration: int,
+        clip_seconds: int = 0,
+        speculative: bool = False,
+    ) -> StreamChoice | None:
+        """
+        获取选中的音视频流，优先使用缓存或进行中的预解析。
+        speculative 表示预解析：请求不重试、不计入熔断，调用方被取消且没有下载在等待时解析一并取消。
+        下载加入的预解析失败时，再按正常请求解析一次
+        """
+        key = (video_id, quality, clip_seconds)
+        cached = self.stream_cache.get(key)
+        if cached is not None:
+            return cached
+        joined_speculation = not speculative and key in self._speculating
+        try:
+            return await self._resolve_flight.do(
+                key,
+                lambda: self._governed_resolve(key, duration, speculative),
+                cancel_unwatched=speculative,
             )
+        except Exception:
+            if not joined_speculation:
+                raise
+        return await self._resolve_flight.do(
+            key, lambda: self._governed_resolve(key, duration, False)
+        )
+
+    async def _governed_resolve(
+        self, key: tuple[str, int | None, int], duration: int, speculative: bool
+    ) -> StreamChoice | None:
+        """经请求管控调用解析函数，成功的结果写入缓存"""
+        video_id, quality, clip_seconds = key
+        if speculative:
+            self._speculating.add(key)
+        try:
+            choice = await self.governor.call(
+                "playurl",
+                lambda: self.resolver(video_id, quality, duration, clip_seconds),
+                speculative=speculative,
+            )
+        finally:
+            if speculative:
+                self._speculating.discard(key)
+        if choice is not None:
+            self.stream_cache.set(key, choice)
+        return choice
+
+    async def _resolve_streams(
+        self, video_id: str, quality: int | None, duration: int, clip_seconds: int = 0
+    ) -> StreamChoice | None:
+        """
+        获取下载链接，按画质上限和体积预算选出音视频流。
+        clip_seconds 不为 0 时只下载开头这么多秒，按片段时长估算体积
+        """
+        # bilibili_api 连带导入 aiohttp 等大量模块，首次下载时才导入，加快插件加载
+        from bilibili_api import video, Credential
+        from bilibili_api.video import VideoDownloadURLDataDetecter, VideoQuality
+
+        v = video.Video(video_id, credential=Credential(sessdata=""))
+        download_url_data = await v.get_download_url(page_index=0)
+        detector = VideoDownloadURLDataDetecter(download_url_data)
+        if not detector.check_video_and_audio_stream():
+            logger.error(f"{video_id} 没有音视频分离的 DASH 流，无法下载")
+            return None
+        if quality:
+            streams = detector.detect(video_max_quality=VideoQuality(quality))
+        else:
+            streams = detector.detect()
+        if clip_seconds:
+            # 文件的实际大小对片段没有参考意义，不核对
+            stream_duration, probe = clip_seconds, None
         else:
-            # 其他平台使用 create_subprocess_shell
-            process = await asyncio.create_subprocess_shell(
-                command, shell=True, stdout=stdout, stderr=stderr
+            # 接口返回的时长更准确，没有时使用搜索结果中的时长
+            stream_duration = download_url_data.get("dash", {}).get("duration") or duration
+            probe = partial(self.downloader.probe_size, headers=self.BILIBILI_HEADER)
+        choice = await select_streams(streams, stream_duration, self.size_budget, probe=probe)
+        if choice is None:
+            logger.error(f"{video_id} 没有可用的音视频流")
+            return None
+        logger.info(
+            f"{video_id} 选用画质 {choice.video.video_quality.name}"
+            f"（{choice.video.video_codecs.name}），音质 {choice.audio.audio_quality.name}，"
+            f"{'大小' if choice.exact else '预计大小'} {choice.size / 1024 / 1024:.1f}MB"
+        )
+        return choice
+
+    async def _download_clip(self, stream, path: str, seconds: int):
+        """
+        按 sidx 分段索引下载流开头约 seconds 秒：先取初始化段和索引（B站的 DASH 流二者相连，
+        都在文件开头），再取覆盖这段时间的子分段追加在后面
+        """
+        index_range = getattr(stream, "segment_base_index_range", "")
+        if not index_range:
+            raise MuxError("流没有分段索引，无法截取预览")
+        index_end = int(index_range.split("-")[1])
+        start = time.monotonic()
+        head_size = await self.downloader.download_range(
+            stream.url, path, 0, index_end, self.BILIBILI_HEADER
+        )
+        async with aiofiles.open(path, "rb") as f:
+            head = await f.read()
+        range_start, range_end, clip_duration = parse_segment_index(head).prefix(seconds)
+        size = head_size + await self.downloader.download_range(
+            stream.url, path, range_start, range_end, self.BILIBILI_HEADER, append=True
+        )
+        elapsed = time.monotonic() - start
+        metrics.observe_download(size, elapsed)
+        logger.info(
+            f"预览片段 {os.path.basename(path)}: {clip_duration:.1f}秒，"
+            f"{size / 1024 / 1024:.1f}MB，用时 {elapsed:.1f}秒"
+        )
+
+    @staticmethod
+    def _progress_logger(file_name: str) -> Callable[[int, int], None]:
+        """按固定间隔输出下载进度日志的回调"""
+        start = time.monotonic()
+        last_log = start
+
+        def on_progress(current: int, total: int):
+            nonlocal last_log
+            now = time.monotonic()
+            if now - last_log < PROGRESS_LOG_INTERVAL:
+                return
+            last_log = now
+            percent = current / total * 100 if total else 0
+            logger.info(
+                f"下载进度 {file_name}: {percent:.0f}% "
+                f"({current / 1024 / 1024:.1f}/{total / 1024 / 1024:.1f}MB, "
+                f"{current / (now - start) / 1024:.0f}KB/s)"
             )
-            await process.communicate()
 
+        return on_progress
+
+    async def _download_b_file(self, url: str, full_file_name: str):
+        """下载单个流，按固定间隔输出进度日志，完成后记录下载速度"""
+        file_name = os.path.basename(full_file_name)
+        start = time.monotonic()
+        size = await self.downloader.download(
+            url,
+            full_file_name,
+            headers=self.BILIBILI_HEADER,
+            progress=self._progress_logger(file_name),
+        )
+        elapsed = time.monotonic() - start
+        metrics.observe_download(size, elapsed)
+        logger.info(
+            f"下载完成 {file_name}: {size / 1024 / 1024:.1f}MB，"
+            f"用时 {elapsed:.1f}秒"
+        )
 
+
+async def _run_together(coros) -> list:
+    """
+    并发运行并返回各自的结果。一路失败或整个任务被取消时停止其余各路，等它们退出后再抛出，
+    否则它们会在调度名额之外继续下载，留下无人清理的文件
+    """
+    tasks = [asyncio.create_task(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
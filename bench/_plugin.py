@@ -0,0 +1,17 @@
+"""把插件目录作为包导入，插件内部使用相对导入，不能直接把模块当脚本加载"""
+import importlib
+import sys
+import types
+from pathlib import Path
+
+PLUGIN_ROOT = Path(__file__).resolve().parent.parent
+PACKAGE = "astrbot_plugin_search_video"
+
+
+def load(module: str = "main") -> types.ModuleType:
+    """导入插件中的模块，如 load("api")，需要在装有 AstrBot 的环境中运行"""
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [str(PLUGIN_ROOT)]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(f"{PACKAGE}.{module}")
@@ -0,0 +1,119 @@
+"""基准测试和压测共用的统计、进程资源采样和运行环境信息"""
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+MB = 1024 * 1024
+
+
+def summarize(samples: list[float]) -> dict:
+    """耗时样本（秒）的统计，单位毫秒"""
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+
+    def percentile(q: float) -> float:
+        index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+        return ordered[index] * 1000
+
+    return {
+        "n": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "min_ms": ordered[0] * 1000,
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def current_rss() -> int:
+    """当前进程的常驻内存（字节），非 Linux 系统退回到历史峰值"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def open_files() -> dict:
+    """当前进程打开的文件描述符数和其中的套接字数，仅 Linux 可用"""
+    try:
+        names = os.listdir("/proc/self/fd")
+    except OSError:
+        return {"fds": -1, "sockets": -1}
+    sockets = 0
+    for name in names:
+        try:
+            if os.readlink(f"/proc/self/fd/{name}").startswith("socket:"):
+                sockets += 1
+        except OSError:
+            pass
+    return {"fds": len(names), "sockets": sockets}
+
+
+class RssSampler:
+    """在后台线程中定时采样常驻内存，记录代码块执行期间的峰值"""
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    def result(self) -> dict:
+        return {
+            "rss_baseline_mb": self.baseline / MB,
+            "rss_peak_mb": self.peak / MB,
+            "rss_growth_mb": (self.peak - self.baseline) / MB,
+        }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run_meta(args) -> dict:
+    """结果文件中的运行环境和参数，用于判断两次结果是否可比"""
+    return {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(args).items()
+        },
+    }
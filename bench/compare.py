@@ -0,0 +1,57 @@
+"""
+对比两次 run_bench.py 的结果：逐项列出中位耗时、吞吐量和内存峰值的变化，
+变差超过阈值的项目标记为回退，存在回退时退出码为 1
+
+    python bench/compare.py before.json after.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+# 指标名后缀 -> 数值越大越好
+METRICS = {"p50_ms": False, "p95_ms": False, "mb_per_s": True, "rss_peak_mb": False}
+
+
+def flatten(report: dict, prefix: str = "") -> dict[str, float]:
+    result = {}
+    for key, value in report.items():
+        if key == "meta":
+            continue
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            result.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and key in METRICS:
+            result[path] = float(value)
+    return result
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=0.1, help="视为回退的相对变化，默认 10%%")
+    args = parser.parse_args(argv)
+
+    with open(args.before, encoding="utf-8") as f:
+        before = flatten(json.load(f))
+    with open(args.after, encoding="utf-8") as f:
+        after = flatten(json.load(f))
+
+    regressions = 0
+    for path in sorted(before.keys() & after.keys()):
+        old, new = before[path], after[path]
+        change = (new - old) / old if old else 0.0
+        higher_is_better = METRICS[path.rsplit(".", 1)[1]]
+        worse = -change if higher_is_better else change
+        mark = ""
+        if worse > args.threshold:
+            mark = "  <- 回退"
+            regressions += 1
+        elif worse < -args.threshold:
+            mark = "  <- 提升"
+        print(f"{path:<55} {old:>10.2f} -> {new:>10.2f} ({change:+.1%}){mark}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+基准测试用的固定数据：B站风格的搜索结果、封面 JPEG 和合成的 DASH 分片 MP4（m4s）。
+所有数据由固定的随机种子生成，同一参数每次生成的内容完全相同
+"""
+import json
+import random
+import struct
+from io import BytesIO
+from pathlib import Path
+from PIL import Image, ImageDraw
+
+# 封面原图尺寸，与B站封面常见尺寸一致
+COVER_SIZE = (672, 378)
+
+_TITLE_WORDS = ["原神", "猫猫", "翻唱", "教程", "开箱", "实况", "混剪", "测评", "vlog", "鬼畜", "纪录片", "MAD"]
+_AUTHORS = ["某科学的UP主", "猫猫头", "Zhalslar", "路过的咸鱼", "测试账号", "bilibili"]
+
+
+def search_results(base_url: str, page: int = 1, count: int = 20, seed: int = 0) -> list[dict]:
+    """生成一页搜索结果，字段与 search/type 接口的视频结果一致，封面指向本地服务器"""
+    rng = random.Random(seed * 1000 + page)
+    results = []
+    for i in range(count):
+        keyword = rng.choice(_TITLE_WORDS)
+        words = "".join(rng.choice(_TITLE_WORDS) for _ in range(rng.randint(2, 8)))
+        minutes, seconds = rng.randint(0, 12), rng.randint(0, 59)
+        results.append(
+            {
+                "type": "video",
+                "bvid": f"BV1bench{page:02d}{i:03d}",
+                "title": f'<em class="keyword">{keyword}</em>{words}&amp;第{i + 1}期',
+                "author": rng.choice(_AUTHORS),
+                "play": rng.randint(0, 5_000_000),
+                "duration": f"{minutes}:{seconds:02d}",
+                "pic": f"{base_url}/cover/{(page - 1) * count + i}.jpg",
+            }
+        )
+    return results
+
+
+def search_response(results: list[dict]) -> bytes:
+    return json.dumps({"code": 0, "message": "0", "data": {"result": results}}).encode()
+
+
+def load_recorded(path: Path, base_url: str) -> list[dict]:
+    """读取录制的真实搜索响应，封面地址改写到本地服务器"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    results = data["data"]["result"] if "data" in data else data
+    for i, item in enumerate(results):
+        item["pic"] = f"{base_url}/cover/{i}.jpg"
+    return results
+
+
+def cover_jpeg(index: int, size: tuple[int, int] = COVER_SIZE) -> bytes:
+    """生成带渐变和色块的封面，内容足够复杂，JPEG 大小接近真实封面"""
+    rng = random.Random(index)
+    width, height = size
+    image = Image.linear_gradient("L").resize(size).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x, y, x + rng.randint(20, 200), y + rng.randint(20, 200)), fill=color)
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+
+def _full_box(box_type: bytes, version: int, flags: int, payload: bytes) -> bytes:
+    return _box(box_type, bytes([version]) + flags.to_bytes(3, "big") + payload)
+
+
+_MATRIX = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def _init_segment(handler: bytes, timescale: int, duration: int) -> bytes:
+    ftyp = _box(b"ftyp", b"iso5" + struct.pack(">I", 512) + b"iso5iso6mp41")
+    mvhd = _full_box(
+        b"mvhd", 0, 0,
+        struct.pack(">IIIIIH", 0, 0, 1000, 0, 0x10000, 0x100)
+        + b"\0" * 10 + _MATRIX + b"\0" * 24 + struct.pack(">I", 2),
+    )
+    tkhd = _full_box(
+        b"tkhd", 0, 3,
+        struct.pack(">IIIII", 0, 0, 1, 0, 0) + b"\0" * 8
+        + struct.pack(">HHHH", 0, 0, 0x100 if handler == b"soun" else 0, 0)
+        + _MATRIX + struct.pack(">II", 1920 << 16, 1080 << 16),
+    )
+    mdhd = _full_box(b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, timescale, duration, 0x55C4, 0))
+    hdlr = _full_box(b"hdlr", 0, 0, b"\0" * 4 + handler + b"\0" * 12 + b"bench\0")
+    media_header = (
+        _full_box(b"vmhd", 0, 1, b"\0" * 8)
+        if handler == b"vide"
+        else _full_box(b"smhd", 0, 0, b"\0" * 4)
+    )
+    dinf = _box(b"dinf", _full_box(b"dref", 0, 0, struct.pack(">I", 1) + _full_box(b"url ", 0, 1, b"")))
+    stbl = _box(
+        b"stbl",
+        _full_box(b"stsd", 0, 0, struct.pack(">I", 0))
+        + _full_box(b"stts", 0, 0, struct.pack(">I", 0))
+        + _full_box(b"stsc", 0, 0, struct.pack(">I", 0))
+        + _full_box(b"stsz", 0, 0, struct.pack(">II", 0, 0))
+        + _full_box(b"stco", 0, 0, struct.pack(">I", 0)),
+    )
+    minf = _box(b"minf", media_header + dinf + stbl)
+    trak = _box(b"trak", tkhd + _box(b"mdia", mdhd + hdlr + minf))
+    mvex = _box(
+        b"mvex",
+        _full_box(b"mehd", 0, 0, struct.pack(">I", duration * 1000 // timescale))
+        + _full_box(b"trex", 0, 0, struct.pack(">IIIII", 1, 1, 0, 0, 0)),
+    )
+    return ftyp + _box(b"moov", mvhd + trak + mvex)
+
+
+def _fragment(sequence: int, decode_time: int, sample_duration: int, sample_sizes: list[int]) -> bytes:
+    """一个 moof，trun 的数据偏移指向紧随其后的 mdat 负载"""
+    def build(data_offset: int) -> bytes:
+        trun = _full_box(
+            b"trun", 0, 0x000301,
+            struct.pack(">Ii", len(sample_sizes), data_offset)
+            + b"".join(struct.pack(">II", sample_duration, size) for size in sample_sizes),
+        )
+        traf = _box(
+            b"traf",
+            _full_box(b"tfhd", 0, 0x020000, struct.pack(">I", 1))
+            + _full_box(b"tfdt", 1, 0, struct.pack(">Q", decode_time))
+            + trun,
+        )
+        return _box(b"moof", _full_box(b"mfhd", 0, 0, struct.pack(">I", sequence)) + traf)
+
+    moof = build(0)
+    return build(len(moof) + 8)
+
+
+def write_m4s(
+    path: Path,
+    handler: bytes,
+    size: int,
+    seconds: float = 60.0,
+    fragment_seconds: float = 2.0,
+    timescale: int = 16000,
+    samples_per_fragment: int = 25,
+    seed: int = 0,
+) -> int:
+    """
+    生成约 size 字节的单轨分片 MP4，负载为随机字节，返回实际文件大小。
+    和B站的 DASH 流一样，初始化段后紧跟 sidx 分段索引
+    """
+    rng = random.Random(seed)
+    fragments = max(1, int(seconds / fragment_seconds))
+    fragment_ticks = int(fragment_seconds * timescale)
+    sample_duration = fragment_ticks // samples_per_fragment
+    payload_size = max(samples_per_fragment, size // fragments)
+    sample_size = payload_size // samples_per_fragment
+    # 每个分片的 moof 长度相同
+    fragment_size = (
+        len(_fragment(1, 0, sample_duration, [sample_size] * samples_per_fragment))
+        + 8
+        + sample_size * samples_per_fragment
+    )
+    sidx = _full_box(
+        b"sidx", 0, 0,
+        struct.pack(">IIIIHH", 1, timescale, 0, 0, 0, fragments)
+        + struct.pack(">III", fragment_size, fragment_ticks, 0x90000000) * fragments,
+    )
+    with open(path, "wb") as f:
+        f.write(_init_segment(handler, timescale, fragments * fragment_ticks))
+        f.write(sidx)
+        for i in range(fragments):
+            sizes = [sample_size] * samples_per_fragment
+            f.write(_fragment(i + 1, i * fragment_ticks, sample_duration, sizes))
+            payload = rng.randbytes(sample_size * samples_per_fragment)
+            f.write(_box(b"mdat", payload))
+        return f.tell()
+
+
+def segment_base(path: Path) -> tuple[str, str]:
+    """write_m4s 生成的文件的初始化段和 sidx 字节区间，格式同B站接口的 segment_base"""
+    with open(path, "rb") as f:
+        data = f.read(64 * 1024)
+    offset = 0
+    while offset < len(data):
+        size, box_type = struct.unpack(">I4s", data[offset : offset + 8])
+        if box_type == b"sidx":
+            return f"0-{offset - 1}", f"{offset}-{offset + size - 1}"
+        offset += size
+    raise ValueError(f"{path} 中没有 sidx")
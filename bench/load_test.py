@@ -0,0 +1,358 @@
+"""
+并发会话压测：用模拟的消息事件和会话等待器驱动 VideoPlugin.search_video_handle，
+对本地替身服务器完成“搜视频 -> 翻页 -> 选择 -> 下载发送”的完整流程。
+逐级提高并发会话数，记录出图、翻页和出视频耗时的 p50/p95/p99、进程内存和文件/套接字数，
+可选在固定并发下持续运行（浸泡测试）观察资源是否泄漏。
+
+在装有 AstrBot 和插件依赖的环境中，从插件目录运行：
+
+    python bench/load_test.py --levels 1,4,16,32 --soak 600 -o load.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import _plugin
+import fixtures
+from _stats import MB, current_rss, open_files, run_meta, summarize
+from server import StandInServer
+
+main_module = _plugin.load("main")
+metrics_module = _plugin.load("metrics")
+streams_module = _plugin.load("streams")
+
+
+class SessionRecord:
+    """一个会话中各个阶段的耗时"""
+    def __init__(self):
+        self.menu: list[float] = []
+        self.flip: list[float] = []
+        self.video: list[float] = []
+        self.errors: list[str] = []
+        self._start = 0.0
+        self._waiting_for = ""
+
+    def expect(self, what: str):
+        """记录用户发出消息的时刻，下一条对应的回复到达时计入耗时"""
+        self._start = time.perf_counter()
+        self._waiting_for = what
+
+    def on_reply(self, kind: str, text: str = ""):
+        elapsed = time.perf_counter() - self._start
+        if kind == "image" and self._waiting_for in ("menu", "flip"):
+            getattr(self, self._waiting_for).append(elapsed)
+            self._waiting_for = ""
+        elif kind == "video" and self._waiting_for == "video":
+            self.video.append(elapsed)
+            self._waiting_for = ""
+        elif kind == "plain" and any(
+            word in text for word in ("失败", "超时", "太多", "没有找到", "错误")
+        ):
+            self.errors.append(text)
+
+
+class FakeEvent:
+    """模拟 AstrMessageEvent，只实现插件用到的方法，发出的消息记入 SessionRecord"""
+    def __init__(self, message: str, group: str, sender: str, record: SessionRecord):
+        self.message_str = message
+        self.group = group
+        self.sender = sender
+        self.record = record
+
+    def plain_result(self, text: str):
+        return ("plain", text)
+
+    def chain_result(self, chain: list):
+        kind = "video" if type(chain[0]).__name__ == "Video" else "image"
+        return (kind, "")
+
+    async def send(self, result):
+        self.record.on_reply(*result)
+
+    def get_group_id(self) -> str:
+        return self.group
+
+    def get_sender_id(self) -> str:
+        return self.sender
+
+    def get_platform_name(self) -> str:
+        return "bench"
+
+    def stop_event(self):
+        pass
+
+
+class FakeController:
+    def __init__(self):
+        self.stopped = False
+
+    def keep(self, timeout: float = 0, reset_timeout: bool = False):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+
+def fake_session_waiter(scripts: dict):
+    """
+    代替 session_waiter：不等待真实消息，而是按事先准备好的脚本依次喂给会话处理函数。
+    scripts 的键为发起搜索的事件，值为 (后续消息列表, 两条消息之间的思考时间)
+    """
+    def session_waiter(timeout: int = 60, record_history_chains: bool = False):
+        def decorator(handler):
+            async def run(event: FakeEvent):
+                inputs, think_time = scripts[event]
+                controller = FakeController()
+                for text in inputs:
+                    await asyncio.sleep(think_time)
+                    event.record.expect("flip" if text.startswith("页") else "video")
+                    await handler(
+                        controller,
+                        FakeEvent(text, event.group, event.sender, event.record),
+                    )
+                    if controller.stopped:
+                        return
+                raise TimeoutError()
+            return run
+        return decorator
+    return session_waiter
+
+
+def make_plugin(server: StandInServer, data_dir: Path, args):
+    """创建指向替身服务器的插件实例：数据目录改到临时目录，取下载链接改为返回本地视频流"""
+    main_module.StarTools = SimpleNamespace(get_data_dir=lambda name: data_dir)
+    config = {
+        "max_duration": 3600,
+        "is_save": not args.no_save,
+        "cards_per_row": args.cards_per_row,
+        "max_concurrent_downloads": args.max_downloads,
+        "download_queue_size": args.queue_size,
+        "cover_deadline": args.cover_deadline,
+        # 替身服务器不做风控，不限制接口请求频率
+        "api_rate_limit": 0,
+    }
+    plugin = main_module.VideoPlugin(SimpleNamespace(), config)
+    plugin.api.BILIBILI_SEARCH_API = server.search_api
+
+    label = SimpleNamespace(name="bench")
+    # 与B站接口一样带上 sidx 的字节区间，下载时直接写出合并结果
+    _, video_index = fixtures.segment_base(server.stream_dir / "video.m4s")
+    _, audio_index = fixtures.segment_base(server.stream_dir / "audio.m4s")
+
+    async def resolve_streams(video_id, quality, duration, clip_seconds=0):
+        return streams_module.StreamChoice(
+            SimpleNamespace(
+                url=server.stream_url("video.m4s"),
+                segment_base_index_range=video_index,
+                video_quality=label,
+                video_codecs=label,
+            ),
+            SimpleNamespace(
+                url=server.stream_url("audio.m4s"),
+                segment_base_index_range=audio_index,
+                audio_quality=label,
+            ),
+            size=0,
+        )
+
+    plugin.api.resolver = resolve_streams
+    return plugin
+
+
+async def run_session(plugin, scripts: dict, session_id: int, args, rng: random.Random) -> SessionRecord:
+    """一个用户的完整会话：搜索、翻若干页、选择一个视频"""
+    record = SessionRecord()
+    keyword = f"load {rng.randrange(args.keywords)}"
+    group = f"group{session_id % args.groups}"
+    event = FakeEvent(f"搜视频{keyword}", group, f"user{session_id}", record)
+    flips = rng.randint(0, args.max_flips)
+    inputs = [f"页{page}" for page in range(2, 2 + flips)]
+    inputs.append(str(rng.randint(1, args.results)))
+    scripts[event] = (inputs, args.think_time)
+    record.expect("menu")
+    try:
+        async for result in plugin.search_video_handle(event):
+            await event.send(result)
+    except Exception as e:
+        record.errors.append(f"{type(e).__name__}: {e}")
+    finally:
+        del scripts[event]
+    return record
+
+
+async def run_level(plugin, scripts: dict, concurrency: int, sessions: int, args, seed: int) -> dict:
+    """以固定并发数运行 sessions 个会话，汇总各阶段耗时"""
+    rng = random.Random(seed)
+    queue = list(range(sessions))
+    records: list[SessionRecord] = []
+    peak_rss = current_rss()
+    peak_files = open_files()
+
+    async def worker():
+        nonlocal peak_rss, peak_files
+        while queue:
+            session_id = queue.pop()
+            records.append(await run_session(plugin, scripts, seed * 100000 + session_id, args, rng))
+            peak_rss = max(peak_rss, current_rss())
+            files = open_files()
+            if files["fds"] > peak_files["fds"]:
+                peak_files = files
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    errors = [error for record in records for error in record.errors]
+    return {
+        "concurrency": concurrency,
+        "sessions": len(records),
+        "seconds": elapsed,
+        "sessions_per_s": len(records) / elapsed,
+        "time_to_menu": summarize([t for r in records for t in r.menu]),
+        "time_to_flip": summarize([t for r in records for t in r.flip]),
+        "time_to_video": summarize([t for r in records for t in r.video]),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "rss_peak_mb": peak_rss / MB,
+        "fds_peak": peak_files["fds"],
+        "sockets_at_fds_peak": peak_files["sockets"],
+    }
+
+
+async def soak(plugin, scripts: dict, args) -> dict:
+    """固定并发持续运行，定时采样内存和文件/套接字数"""
+    rng = random.Random(args.seed)
+    deadline = time.monotonic() + args.soak
+    samples = []
+    completed = 0
+
+    async def worker(index: int):
+        nonlocal completed
+        session_id = 0
+        while time.monotonic() < deadline:
+            await run_session(plugin, scripts, index * 1000000 + session_id, args, rng)
+            session_id += 1
+            completed += 1
+
+    async def sampler():
+        start = time.monotonic()
+        while time.monotonic() < deadline:
+            samples.append(
+                {
+                    "t": round(time.monotonic() - start, 1),
+                    "rss_mb": current_rss() / MB,
+                    "sessions": completed,
+                    **open_files(),
+                }
+            )
+            await asyncio.sleep(args.sample_interval)
+
+    await asyncio.gather(sampler(), *(worker(i) for i in range(args.soak_concurrency)))
+    # 前 10% 的采样是预热阶段，之后的增长才可能是泄漏
+    settled = samples[len(samples) // 10 :] or samples
+    return {
+        "concurrency": args.soak_concurrency,
+        "seconds": args.soak,
+        "sessions": completed,
+        "rss_growth_mb": settled[-1]["rss_mb"] - settled[0]["rss_mb"],
+        "fds_growth": settled[-1]["fds"] - settled[0]["fds"],
+        "sockets_growth": settled[-1]["sockets"] - settled[0]["sockets"],
+        "samples": samples,
+    }
+
+
+async def run(args) -> dict:
+    work_dir = Path(tempfile.mkdtemp(prefix="search_video_load_"))
+    stream_dir = work_dir / "streams"
+    stream_dir.mkdir()
+    fixtures.write_m4s(stream_dir / "video.m4s", b"vide", args.stream_mb * MB, seed=1)
+    fixtures.write_m4s(stream_dir / "audio.m4s", b"soun", max(1, args.stream_mb // 8) * MB, seed=2)
+    server = StandInServer(stream_dir, latency=args.latency, results_per_page=args.results)
+    await server.start()
+
+    scripts: dict = {}
+    main_module.session_waiter = fake_session_waiter(scripts)
+    plugin = make_plugin(server, work_dir / "data", args)
+    report = {"meta": run_meta(args), "levels": []}
+    try:
+        for i, concurrency in enumerate(args.levels):
+            print(f"concurrency {concurrency}...", file=sys.stderr)
+            report["levels"].append(
+                await run_level(
+                    plugin, scripts, concurrency, concurrency * args.sessions_per_worker, args, args.seed + i
+                )
+            )
+        if args.soak:
+            print(f"soak {args.soak}s at concurrency {args.soak_concurrency}...", file=sys.stderr)
+            report["soak"] = await soak(plugin, scripts, args)
+        report["stages"] = {
+            stage: summarize_histogram(histogram)
+            for stage, histogram in metrics_module.metrics.stages.items()
+        }
+        report["stage_errors"] = dict(metrics_module.metrics.errors)
+        report["meta"]["requests"] = dict(server.requests)
+    finally:
+        await plugin.terminate()
+        await server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def summarize_histogram(histogram) -> dict:
+    return {
+        "n": histogram.count,
+        "mean_ms": histogram.sum / histogram.count * 1000 if histogram.count else 0.0,
+        "p50_ms": histogram.quantile(0.5) * 1000,
+        "p95_ms": histogram.quantile(0.95) * 1000,
+        "p99_ms": histogram.quantile(0.99) * 1000,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", help="结果 JSON 文件，默认输出到标准输出")
+    parser.add_argument(
+        "--levels",
+        type=lambda text: [int(n) for n in text.split(",")],
+        default=[1, 2, 4, 8, 16, 32],
+        help="逗号分隔的并发会话数，逐级运行",
+    )
+    parser.add_argument("--sessions-per-worker", type=int, default=4, help="每级中每个并发会话运行几次")
+    parser.add_argument("--soak", type=float, default=0, help="浸泡测试时长（秒），0 为不运行")
+    parser.add_argument("--soak-concurrency", type=int, default=8)
+    parser.add_argument("--sample-interval", type=float, default=5.0, help="浸泡测试的采样间隔（秒）")
+    parser.add_argument("--groups", type=int, default=4, help="会话分布在几个群中")
+    parser.add_argument("--keywords", type=int, default=50, help="不同搜索关键词的数量，越少缓存命中越多")
+    parser.add_argument("--max-flips", type=int, default=2, help="每个会话最多翻几页")
+    parser.add_argument("--think-time", type=float, default=0.2, help="用户两条消息之间的间隔（秒）")
+    parser.add_argument("--results", type=int, default=20, help="每页搜索结果数")
+    parser.add_argument("--cards-per-row", type=int, default=18)
+    parser.add_argument("--cover-deadline", type=float, default=2.0)
+    parser.add_argument("--max-downloads", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--no-save", action="store_true", help="不保存视频，每次选择都重新下载")
+    parser.add_argument("--stream-mb", type=int, default=8, help="合成视频流的大小（MB），音频流为其 1/8")
+    parser.add_argument("--latency", type=float, default=0.02, help="替身服务器每个请求的延迟（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+离线基准测试：启动本地替身服务器，测量菜单渲染、封面缓存、搜索和下载/合并的性能，
+结果以 JSON 输出，可用 compare.py 对比两个版本。
+
+在装有 AstrBot 和插件依赖的环境中，从插件目录运行：
+
+    python bench/run_bench.py -o before.json
+    python bench/run_bench.py -o after.json
+    python bench/compare.py before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import _plugin
+import fixtures
+from _stats import MB, RssSampler, run_meta, summarize
+from server import StandInServer
+
+client_module = _plugin.load("client")
+draw_module = _plugin.load("draw")
+api_module = _plugin.load("api")
+downloader_module = _plugin.load("downloader")
+muxer_module = _plugin.load("muxer")
+models_module = _plugin.load("models")
+streams_module = _plugin.load("streams")
+governor_module = _plugin.load("governor")
+
+
+async def bench_render(server: StandInServer, work_dir: Path, args) -> dict:
+    """不同每行卡片数下的菜单渲染耗时和内存峰值（封面已在缓存中，不使用菜单图缓存）"""
+    client = client_module.HttpClient()
+    renderer = draw_module.VideoCardRenderer(
+        client,
+        cache_dir=work_dir / "render_cache",
+        executor=args.executor,
+        cover_deadline=60,
+        menu_cache_items=0,
+        image_format=args.image_format,
+        image_max_bytes=args.image_max_kb * 1024,
+    )
+    video_list = models_module.parse_results(
+        fixtures.load_recorded(args.search_json, server.base_url)
+        if args.search_json
+        else fixtures.search_results(server.base_url, 1, args.results)
+    )
+    try:
+        # 预热：下载封面，构建字体和静态图层
+        await renderer.render_video_list_image(video_list, cards_per_row=3)
+        results = {}
+        for cards_per_row in args.cards_per_row:
+            samples = []
+            with RssSampler() as rss:
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    image = await renderer.render_video_list_image(
+                        video_list, cards_per_row=cards_per_row
+                    )
+                    samples.append(time.perf_counter() - start)
+            results[str(cards_per_row)] = {
+                **summarize(samples),
+                **rss.result(),
+                "image_bytes": len(image),
+            }
+        return {
+            "cards": len(video_list),
+            "executor": args.executor,
+            "image_format": args.image_format,
+            "image_max_kb": args.image_max_kb,
+            "cards_per_row": results,
+        }
+    finally:
+        await renderer.close()
+        await client.close()
+
+
+async def bench_thumbnail(server: StandInServer, work_dir: Path, args) -> dict:
+    """封面三种情况的单张耗时：未命中（下载、解码、缩放、写盘）、磁盘命中、内存命中"""
+    client = client_module.HttpClient()
+    cache_dir = work_dir / "thumb_cache"
+    urls = [f"{server.base_url}/cover/{i}.jpg" for i in range(args.results)]
+
+    def make_renderer():
+        return draw_module.VideoCardRenderer(client, cache_dir=cache_dir, cover_deadline=60)
+
+    async def timed(fetch) -> list[float]:
+        samples = []
+        for url in urls:
+            start = time.perf_counter()
+            await fetch(url)
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    try:
+        cold = make_renderer()
+        miss = await timed(cold.download_image)
+        memory_hit = await timed(cold.download_image)
+        await cold.close()
+        # 新实例的内存层为空，只能从磁盘读取
+        warm = make_renderer()
+        disk_hit = await timed(warm.download_image)
+        await warm.close()
+        return {
+            "miss": summarize(miss),
+            "disk_hit": summarize(disk_hit),
+            "memory_hit": summarize(memory_hit),
+        }
+    finally:
+        await client.close()
+
+
+async def bench_search(server: StandInServer, work_dir: Path, args) -> dict:
+    """search_video 在缓存未命中（请求替身接口）和命中时的耗时"""
+    client = client_module.HttpClient()
+    # 只测量插件自身的开销，不限制接口请求频率
+    api = api_module.VideoAPI("", client, governor=governor_module.RequestGovernor(rate=0))
+    api.BILIBILI_SEARCH_API = server.search_api
+    try:
+        miss = []
+        for i in range(args.repeats):
+            start = time.perf_counter()
+            await api.search_video(f"bench keyword {i}", page=1)
+            miss.append(time.perf_counter() - start)
+        hit = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            await api.search_video("bench keyword 0", page=1)
+            hit.append(time.perf_counter() - start)
+        return {"miss": summarize(miss), "hit": summarize(hit)}
+    finally:
+        await api.close()
+        await client.close()
+
+
+async def bench_download(server: StandInServer, work_dir: Path, args) -> dict:
+    """分段下载音视频流和合并的吞吐量"""
+    stream_dir = server.stream_dir
+    video_size = fixtures.write_m4s(stream_dir / "video.m4s", b"vide", args.stream_mb * MB, seed=1)
+    audio_size = fixtures.write_m4s(
+        stream_dir / "audio.m4s", b"soun", max(1, args.stream_mb // 8) * MB, seed=2
+    )
+    total = video_size + audio_size
+    out_dir = work_dir / "download"
+    out_dir.mkdir(exist_ok=True)
+    client = client_module.HttpClient()
+    results = {"bytes": total}
+    try:
+        for segments in sorted({1, args.segments}):
+            downloader = downloader_module.SegmentedDownloader(client, segments=segments)
+            samples = []
+            for _ in range(args.download_repeats):
+                for name in ("video.m4s", "audio.m4s"):
+                    (out_dir / name).unlink(missing_ok=True)
+                start = time.perf_counter()
+                await asyncio.gather(
+                    downloader.download(server.stream_url("video.m4s"), str(out_dir / "video.m4s")),
+                    downloader.download(server.stream_url("audio.m4s"), str(out_dir / "audio.m4s")),
+                )
+                samples.append(time.perf_counter() - start)
+            results[f"download_segments_{segments}"] = {
+                **summarize(samples),
+                "mb_per_s": total / MB / statistics.median(samples),
+            }
+
+        samples = []
+        merged = out_dir / "merged.mp4"
+        for _ in range(args.download_repeats):
+            start = time.perf_counter()
+            await asyncio.to_thread(
+                muxer_module.remux_dash,
+                str(out_dir / "video.m4s"),
+                str(out_dir / "audio.m4s"),
+                str(merged),
+            )
+            samples.append(time.perf_counter() - start)
+        results["merge"] = {
+            **summarize(samples),
+            "mb_per_s": total / MB / statistics.median(samples),
+        }
+        return results
+    finally:
+        await client.close()
+
+
+async def bench_preview(server: StandInServer, work_dir: Path, args) -> dict:
+    """按 sidx 截取开头片段并合并的耗时，以及与完整下载相比的数据量"""
+    stream_dir = server.stream_dir
+    video_size = fixtures.write_m4s(
+        stream_dir / "long_video.m4s", b"vide", args.stream_mb * MB, seconds=600, seed=3
+    )
+    audio_size = fixtures.write_m4s(
+        stream_dir / "long_audio.m4s", b"soun", max(1, args.stream_mb // 8) * MB, seconds=600, seed=4
+    )
+
+    def stream(name: str):
+        _, index_range = fixtures.segment_base(stream_dir / name)
+        return SimpleNamespace(url=server.stream_url(name), segment_base_index_range=index_range)
+
+    choice = streams_module.StreamChoice(stream("long_video.m4s"), stream("long_audio.m4s"), size=0)
+
+    async def resolve_streams(video_id, quality, duration, clip_seconds=0):
+        return choice
+
+    client = client_module.HttpClient()
+    api = api_module.VideoAPI("", client, resolver=resolve_streams)
+    out_dir = work_dir / "preview"
+    try:
+        samples = []
+        for i in range(args.download_repeats):
+            start = time.perf_counter()
+            path = await api.download_preview(f"BVbench{i}", str(out_dir), args.preview_seconds)
+            samples.append(time.perf_counter() - start)
+        clip_size = Path(path).stat().st_size
+        return {
+            **summarize(samples),
+            "seconds": args.preview_seconds,
+            "clip_bytes": clip_size,
+            "full_bytes": video_size + audio_size,
+            "fraction": clip_size / (video_size + audio_size),
+        }
+    finally:
+        await api.close()
+        await client.close()
+
+
+BENCHMARKS = {
+    "render": bench_render,
+    "thumbnail": bench_thumbnail,
+    "search": bench_search,
+    "download": bench_download,
+    "preview": bench_preview,
+}
+
+
+async def run(args) -> dict:
+    work_dir = Path(tempfile.mkdtemp(prefix="search_video_bench_"))
+    stream_dir = work_dir / "streams"
+    stream_dir.mkdir()
+    server = StandInServer(stream_dir, latency=args.latency, results_per_page=args.results)
+    await server.start()
+    report = {"meta": run_meta(args)}
+    try:
+        for name in args.only or BENCHMARKS:
+            print(f"running {name}...", file=sys.stderr)
+            report[name] = await BENCHMARKS[name](server, work_dir, args)
+        report["meta"]["requests"] = dict(server.requests)
+    finally:
+        await server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", help="结果 JSON 文件，默认输出到标准输出")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="只运行指定的测试")
+    parser.add_argument("--repeats", type=int, default=10, help="渲染和搜索的重复次数")
+    parser.add_argument(
+        "--cards-per-row",
+        type=lambda text: [int(n) for n in text.split(",")],
+        default=[3, 6, 12, 18],
+        help="逗号分隔的每行卡片数",
+    )
+    parser.add_argument("--results", type=int, default=20, help="每页搜索结果数")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    parser.add_argument("--image-format", choices=["jpeg", "webp"], default="jpeg", help="菜单图格式")
+    parser.add_argument("--image-max-kb", type=int, default=0, help="菜单图体积上限（KB），0 为固定画质")
+    parser.add_argument("--latency", type=float, default=0.0, help="替身服务器每个请求的延迟（秒）")
+    parser.add_argument("--stream-mb", type=int, default=64, help="合成视频流的大小（MB），音频流为其 1/8")
+    parser.add_argument("--segments", type=int, default=4, help="分段下载数，同时测量不分段的情况")
+    parser.add_argument("--download-repeats", type=int, default=3)
+    parser.add_argument("--preview-seconds", type=int, default=30, help="预览片段时长（秒），合成的长视频为 10 分钟")
+    parser.add_argument("--search-json", type=Path, help="录制的真实搜索响应，代替生成的搜索结果用于渲染测试")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+本地替身服务器：代替B站搜索接口、封面图床和视频 CDN，供基准测试和压测使用。
+视频流用 FileResponse 提供，支持 Range 请求，与 CDN 一样返回 206 和 Content-Range
+"""
+import asyncio
+from collections import Counter
+from pathlib import Path
+from aiohttp import web
+import fixtures
+
+
+class StandInServer:
+    def __init__(
+        self,
+        stream_dir: Path,
+        latency: float = 0.0,
+        results_per_page: int = 20,
+        recorded: Path | None = None,
+    ):
+        self.stream_dir = stream_dir
+        # 每个请求额外等待的秒数，模拟网络往返
+        self.latency = latency
+        self.results_per_page = results_per_page
+        self.recorded = recorded
+        self.requests: Counter[str] = Counter()
+        self.base_url = ""
+        self._covers: dict[int, bytes] = {}
+        self._runner: web.AppRunner | None = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_get("/x/web-interface/search/type", self._search)
+        app.router.add_get("/cover/{index:\\d+}.jpg", self._cover)
+        app.router.add_get("/stream/{name}", self._stream)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @property
+    def search_api(self) -> str:
+        return f"{self.base_url}/x/web-interface/search/type"
+
+    def stream_url(self, name: str) -> str:
+        return f"{self.base_url}/stream/{name}"
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def _search(self, request: web.Request) -> web.Response:
+        self.requests["search"] += 1
+        await self._delay()
+        page = int(request.query.get("page", 1))
+        if self.recorded is not None:
+            results = fixtures.load_recorded(self.recorded, self.base_url) if page == 1 else []
+        else:
+            results = fixtures.search_results(self.base_url, page, self.results_per_page)
+        return web.Response(
+            body=fixtures.search_response(results), content_type="application/json"
+        )
+
+    async def _cover(self, request: web.Request) -> web.Response:
+        self.requests["cover"] += 1
+        await self._delay()
+        index = int(request.match_info["index"])
+        if index not in self._covers:
+            self._covers[index] = fixtures.cover_jpeg(index)
+        return web.Response(body=self._covers[index], content_type="image/jpeg")
+
+    async def _stream(self, request: web.Request) -> web.StreamResponse:
+        self.requests["stream"] += 1
+        await self._delay()
+        path = self.stream_dir / request.match_info["name"]
+        if not path.is_file():
+            raise web.HTTPNotFound()
+        return web.FileResponse(path)
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class TTLCache:
+    """
+    带过期时间的 LRU 缓存，超出容量时淘汰最久未使用的条目，ttl 为 None 时永不过期。
+    过期条目在被淘汰前仍占用容量
+    """
+    def __init__(self, maxsize: int = 256, ttl: float | None = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            # 过期条目保留到被淘汰为止，源站不可用时还能用 get_stale 取出
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get_stale(self, key: Hashable, default: Any = None) -> Any:
+        """取条目，已过期的也返回，不计入命中统计"""
+        item = self._data.get(key)
+        return default if item is None else item[1]
+
+    def set(self, key: Hashable, value: Any):
+        expires_at = float("inf") if self.ttl is None else time.monotonic() + self.ttl
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """命中统计"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class SingleFlight:
+    """
+    合并相同键的并发调用：同一时刻每个键只执行一次，其余调用方等待同一个结果
+    """
+    def __init__(self):
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+        # 每个键正在等待结果的调用方数
+        self._waiters: dict[Hashable, int] = {}
+
+    def task(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        """获取该键正在执行的任务，没有则用 factory 创建一个"""
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        return task
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        """移除该键的任务，键已换成新任务时不动"""
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    async def do(
+        self,
+        key: Hashable,
+        factory: Callable[[], Awaitable[Any]],
+        cancel_unwatched: bool = False,
+    ) -> Any:
+        """
+        执行或加入该键的调用；单个调用方被取消不会影响其他等待者。
+        cancel_unwatched 为 True 时，本调用方被取消且没有其他等待者，一并取消这次调用
+        """
+        task = self.task(key, factory)
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if cancel_unwatched and self._waiters[key] == 1:
+                # 先移除再取消，之后加入的调用方会发起新的调用，而不是等到一个被取消的任务
+                self._forget(key, task)
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] == 0:
+                del self._waiters[key]
+
+    async def cancel_all(self):
+        """取消所有进行中的调用并等待它们结束，关闭时使用"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._tasks
@@ -0,0 +1,87 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+from astrbot import logger
+
+if TYPE_CHECKING:
+    import httpx
+
+
+class HttpClient:
+    """
+    共享的连接池 HTTP 客户端，搜索、封面下载、视频流下载共用同一个连接池
+    """
+    def __init__(
+        self,
+        pool_size: int = 20,
+        per_host_limit: int = 8,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        timeout: float = 15.0,
+    ):
+        self.per_host_limit = per_host_limit
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.timeout = timeout
+        # httpx 在第一次请求时才导入并创建客户端，加快插件加载
+        self._client: "httpx.AsyncClient | None" = None
+        # 关闭后不再创建新的客户端，防止插件卸载后遗留无人关闭的连接池
+        self._closed = False
+        # 每个域名一个信号量，限制单个域名的并发连接数
+        self._host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+    @property
+    def client(self) -> "httpx.AsyncClient":
+        if self._closed:
+            raise RuntimeError("HTTP 连接池已关闭")
+        if self._client is None:
+            import httpx
+
+            http2 = self.http2
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    logger.warning("未安装 h2 库，已回退为 HTTP/1.1")
+                    http2 = False
+
+            self._client = httpx.AsyncClient(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(self.timeout),
+                follow_redirects=True,
+            )
+        return self._client
+
+    def _host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host_limit)
+            self._host_semaphores[host] = semaphore
+        return semaphore
+
+    async def get(self, url: str, **kwargs) -> "httpx.Response":
+        """GET 请求，响应体会被完整读取"""
+        async with self._host_semaphore(url):
+            return await self.client.get(url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        """流式请求，占用该域名的一个连接名额直到读取结束"""
+        async with self._host_semaphore(url):
+            async with self.client.stream(method, url, **kwargs) as resp:
+                yield resp
+
+    async def close(self):
+        """关闭连接池，之后的请求会抛出 RuntimeError"""
+        self._closed = True
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,545 @@
+import asyncio
+import bisect
+import json
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, BinaryIO, Callable
+import aiofiles
+import aiofiles.os
+from astrbot import logger
+from .client import HttpClient
+from .limiter import TokenBucket
+from .governor import is_retryable
+
+if TYPE_CHECKING:
+    import httpx
+
+# 下载残留文件的保留时间（秒），超过后不再续传
+PARTIAL_MAX_AGE = 24 * 3600
+
+
+@dataclass
+class _Plan:
+    """分段下载计划"""
+    size: int
+    etag: str
+    # 每段的 [起始, 结束] 字节区间（闭区间）
+    ranges: list[tuple[int, int]]
+    # 每段已写入的字节数
+    done: list[int]
+
+
+class SegmentedDownloader:
+    """
+    分段并发下载器：大文件按字节区间拆成多段，通过连接池并发下载并写入预分配的文件，
+    单段失败只重试该段，中断后可以从已下载的位置续传；小文件只发一个请求
+    """
+    def __init__(
+        self,
+        client: HttpClient,
+        segments: int = 4,
+        min_segment_size: int = 4 * 1024 * 1024,
+        retries: int = 3,
+        backoff: float = 0.5,
+        limiter: TokenBucket | None = None,
+    ):
+        self.client = client
+        self.segments = max(1, segments)
+        # 第一个请求取这么多字节，不超过此大小的文件一个请求即可下完
+        self.min_segment_size = min_segment_size
+        self.retries = retries
+        self.backoff = backoff
+        # 所有下载共用的带宽限速器，每写入一块数据取相应字节数的令牌
+        self.limiter = limiter
+
+    async def download(
+        self,
+        url: str,
+        path: str,
+        headers: dict | None = None,
+        progress: Callable[[int, int], None] | None = None,
+    ) -> int:
+        """
+        下载 url 到 path，返回文件大小。
+        下载过程中写入 path.part，进度保存在 path.part.state，完成后原子重命名为 path
+        """
+        import httpx
+
+        headers = headers or {}
+        part_path = path + ".part"
+        state_path = part_path + ".state"
+
+        for attempt in range(self.retries + 1):
+            try:
+                plan = await self._download_head(
+                    url, part_path, state_path, headers, progress
+                )
+                break
+            except (httpx.HTTPError, OSError) as e:
+                if attempt == self.retries or not _retryable(e):
+                    raise
+                await self._sleep_backoff(attempt, f"下载失败（{e}）")
+
+        if plan is not None:
+            await self._download_segments(url, part_path, state_path, headers, plan, progress)
+
+        await aiofiles.os.replace(part_path, path)
+        if await aiofiles.os.path.exists(state_path):
+            await aiofiles.os.remove(state_path)
+        return await aiofiles.os.path.getsize(path)
+
+    async def probe_size(self, url: str, headers: dict | None = None) -> int | None:
+        """只取一个字节来确认文件大小，失败或无法确定时返回 None"""
+        import httpx
+
+        try:
+            async with self.client.stream(
+                "GET", url, headers={**(headers or {}), "Range": "bytes=0-0"}
+            ) as resp:
+                resp.raise_for_status()
+                size = _total_size(resp)
+                if size is None and resp.status_code == 200:
+                    # 不支持 Range 时从 Content-Length 取大小，不读取响应体
+                    size = int(resp.headers.get("content-length", 0)) or None
+                return size
+        except (httpx.HTTPError, ValueError) as e:
+            logger.debug(f"获取文件大小失败 {url}: {e}")
+            return None
+
+    async def download_range(
+        self,
+        url: str,
+        path: str,
+        start: int,
+        end: int,
+        headers: dict | None = None,
+        append: bool = False,
+    ) -> int:
+        """
+        下载 [start, end] 字节区间写入 path，append 为 True 时追加到文件末尾。
+        失败时从已写入的位置重试，返回写入的字节数
+        """
+        import httpx
+
+        headers = headers or {}
+        written = 0
+        async with aiofiles.open(path, "ab" if append else "wb") as f:
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self.client.stream(
+                        "GET",
+                        url,
+                        headers={**headers, "Range": f"bytes={start + written}-{end}"},
+                    ) as resp:
+                        if resp.status_code != 206:
+                            raise httpx.HTTPStatusError(
+                                f"区间请求返回 {resp.status_code}",
+                                request=resp.request,
+                                response=resp,
+                            )
+                        async for chunk in resp.aiter_bytes():
+                            chunk = chunk[: end + 1 - start - written]
+                            await self._throttle(len(chunk))
+                            await f.write(chunk)
+                            written += len(chunk)
+                    if start + written > end:
+                        return written
+                    raise httpx.ReadError("区间数据不完整")
+                except (httpx.HTTPError, OSError) as e:
+                    if attempt == self.retries or not _retryable(e):
+                        raise
+                    await self._sleep_backoff(
+                        attempt, f"区间下载失败（{e}），将从 {start + written} 处重试"
+                    )
+        return written
+
+    async def read_range(
+        self, url: str, start: int, end: int, headers: dict | None = None
+    ) -> bytes:
+        """读取 [start, end] 字节区间到内存，用于文件头部等小区间，失败时重试"""
+        import httpx
+
+        attempt = 0
+        while True:
+            try:
+                resp = await self.client.get(
+                    url, headers={**(headers or {}), "Range": f"bytes={start}-{end}"}
+                )
+                if resp.status_code != 206:
+                    raise httpx.HTTPStatusError(
+                        f"区间请求返回 {resp.status_code}", request=resp.request, response=resp
+                    )
+                data = resp.content[: end + 1 - start]
+                if len(data) < end + 1 - start:
+                    raise httpx.ReadError("区间数据不完整")
+                await self._throttle(len(data))
+                return data
+            except httpx.HTTPError as e:
+                if attempt == self.retries or not _retryable(e):
+                    raise
+                await self._sleep_backoff(attempt, f"区间读取失败（{e}）")
+                attempt += 1
+
+    def scatter_plan(self, extents: list[tuple[int, int, int]]) -> _Plan:
+        """把 extents 覆盖的源区间切分为并发下载的分段，每段不小于 min_segment_size"""
+        start, end = extents[0][0], extents[-1][1]
+        size = end - start + 1
+        count = max(1, min(self.segments, -(-size // self.min_segment_size)))
+        step = -(-size // count)
+        ranges = [(s, min(s + step, end + 1) - 1) for s in range(start, end + 1, step)]
+        return _Plan(size, "", ranges, [0] * len(ranges))
+
+    async def download_scattered(
+        self,
+        url: str,
+        path: str,
+        extents: list[tuple[int, int, int]],
+        plan: _Plan,
+        headers: dict | None = None,
+        progress: Callable[[int, int], None] | None = None,
+    ):
+        """
+        按 plan 并发下载源文件的各段，数据按 extents [(源起始, 源结束, 输出偏移)] 直接写到
+        path 中的输出位置，path 需已预分配。各段失败时从已写入的位置重试，
+        plan.done 记录进度，调用方可以保存下来续传
+        """
+        tracker = _Progress(plan.size, sum(plan.done), progress)
+        tasks = [
+            asyncio.create_task(
+                self._download_scattered_range(url, path, extents, headers or {}, plan, i, tracker)
+            )
+            for i in range(len(plan.ranges))
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _download_scattered_range(
+        self,
+        url: str,
+        path: str,
+        extents: list[tuple[int, int, int]],
+        headers: dict,
+        plan: _Plan,
+        i: int,
+        tracker: "_Progress",
+    ):
+        """下载第 i 段并分散写入输出，失败时从该段已写入的位置重试"""
+        import httpx
+
+        start, end = plan.ranges[i]
+        starts = [extent[0] for extent in extents]
+        f = await asyncio.to_thread(open, path, "r+b")
+        try:
+            for attempt in range(self.retries + 1):
+                if start + plan.done[i] > end:
+                    return
+                try:
+                    async with self.client.stream(
+                        "GET",
+                        url,
+                        headers={**headers, "Range": f"bytes={start + plan.done[i]}-{end}"},
+                    ) as resp:
+                        if resp.status_code != 206:
+                            raise httpx.HTTPStatusError(
+                                f"分段请求返回 {resp.status_code}",
+                                request=resp.request,
+                                response=resp,
+                            )
+                        async for chunk in resp.aiter_bytes():
+                            chunk = chunk[: end + 1 - start - plan.done[i]]
+                            await self._throttle(len(chunk))
+                            await asyncio.to_thread(
+                                _scatter_write, f, extents, starts, start + plan.done[i], chunk
+                            )
+                            plan.done[i] += len(chunk)
+                            tracker.advance(len(chunk))
+                    if start + plan.done[i] > end:
+                        return
+                    raise httpx.ReadError("分段数据不完整")
+                except (httpx.HTTPError, OSError) as e:
+                    if attempt == self.retries or not _retryable(e):
+                        raise
+                    await self._sleep_backoff(
+                        attempt, f"第{i + 1}段下载失败（{e}），将从 {start + plan.done[i]} 处重试"
+                    )
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def warm(self, url: str, headers: dict | None = None, size: int = 256 * 1024):
+        """
+        预先请求文件开头的 size 字节并丢弃，让 CDN 节点缓存文件头部、连接池留下可复用的连接，
+        随后的正式下载能更快拿到首字节。失败时忽略
+        """
+        import httpx
+
+        try:
+            async with self.client.stream(
+                "GET", url, headers={**(headers or {}), "Range": f"bytes=0-{size - 1}"}
+            ) as resp:
+                resp.raise_for_status()
+                received = 0
+                async for chunk in resp.aiter_bytes():
+                    await self._throttle(len(chunk))
+                    received += len(chunk)
+                    if received >= size:
+                        break
+        except httpx.HTTPError as e:
+            logger.debug(f"预热失败 {url}: {e}")
+
+    async def _download_head(
+        self,
+        url: str,
+        part_path: str,
+        state_path: str,
+        headers: dict,
+        progress: Callable[[int, int], None] | None,
+    ) -> _Plan | None:
+        """
+        发出第一个请求：服务器不支持 Range 或文件足够小时直接下完并返回 None，
+        否则写入文件头部，返回剩余分段的下载计划
+        """
+        import httpx
+
+        # 有续传进度时只需确认文件大小，不必再取头部数据
+        head_end = 0 if await aiofiles.os.path.exists(state_path) else self.min_segment_size - 1
+        async with self.client.stream(
+            "GET", url, headers={**headers, "Range": f"bytes=0-{head_end}"}
+        ) as resp:
+            resp.raise_for_status()
+            etag = resp.headers.get("etag", "")
+            size = _total_size(resp)
+
+            if size is None:
+                # 不支持 Range，整个文件在这一个响应里
+                total = int(resp.headers.get("content-length", 0))
+                tracker = _Progress(total, 0, progress)
+                async with aiofiles.open(part_path, "wb") as f:
+                    async for chunk in resp.aiter_bytes():
+                        await self._throttle(len(chunk))
+                        await f.write(chunk)
+                        tracker.advance(len(chunk))
+                return None
+
+            plan = await asyncio.to_thread(self._plan, size, etag, state_path, part_path)
+            if any(plan.done):
+                logger.info(
+                    f"续传 {os.path.basename(part_path)}，"
+                    f"已完成 {sum(plan.done)}/{size} 字节"
+                )
+                return plan
+
+            async with aiofiles.open(part_path, "wb") as f:
+                # 预分配文件，各段直接写入自己的位置
+                await f.truncate(size)
+                if head_end == 0:
+                    # 续传进度已失效，所有分段（包括头部）都重新下载
+                    await aiofiles.os.remove(state_path)
+                    return plan
+                tracker = _Progress(size, 0, progress)
+                async for chunk in resp.aiter_bytes():
+                    chunk = chunk[: plan.ranges[0][1] + 1 - plan.done[0]]
+                    await self._throttle(len(chunk))
+                    await f.write(chunk)
+                    tracker.advance(len(chunk))
+                    plan.done[0] += len(chunk)
+
+        if plan.done[0] < plan.ranges[0][1] + 1:
+            raise httpx.ReadError("文件头部数据不完整")
+        return plan if len(plan.ranges) > 1 else None
+
+    def _plan(self, size: int, etag: str, state_path: str, part_path: str) -> _Plan:
+        """
+        切分字节区间并读取续传进度：第一段为首个请求的头部，其余部分按段数均分。
+        需要读文件，在线程中执行
+        """
+        head = min(size, self.min_segment_size)
+        ranges = [(0, head - 1)]
+        rest = size - head
+        if rest > 0:
+            count = min(self.segments, -(-rest // self.min_segment_size))
+            step = -(-rest // count)
+            ranges += [
+                (start, min(start + step, size) - 1) for start in range(head, size, step)
+            ]
+
+        done = [0] * len(ranges)
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if (
+                state["size"] == size
+                and state["etag"] == etag
+                and len(state["done"]) == len(ranges)
+                and os.path.getsize(part_path) == size
+            ):
+                done = [int(n) for n in state["done"]]
+        except (OSError, ValueError, KeyError):
+            pass
+        return _Plan(size, etag, ranges, done)
+
+    async def _download_segments(
+        self,
+        url: str,
+        part_path: str,
+        state_path: str,
+        headers: dict,
+        plan: _Plan,
+        progress: Callable[[int, int], None] | None,
+    ):
+        """并发下载所有未完成的分段，失败或取消时保存进度供续传"""
+        tracker = _Progress(plan.size, sum(plan.done), progress)
+        tasks = [
+            asyncio.create_task(
+                self._download_range(url, part_path, headers, plan, i, tracker)
+            )
+            for i in range(len(plan.ranges))
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # 某段彻底失败或被取消时停止其余各段，文件句柄都关闭后再保存进度
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            async with aiofiles.open(state_path, "w") as f:
+                await f.write(
+                    json.dumps({"size": plan.size, "etag": plan.etag, "done": plan.done})
+                )
+            raise
+
+    async def _download_range(
+        self,
+        url: str,
+        part_path: str,
+        headers: dict,
+        plan: _Plan,
+        i: int,
+        tracker: "_Progress",
+    ):
+        """下载第 i 段，失败时从该段已写入的位置重试"""
+        import httpx
+
+        start, end = plan.ranges[i]
+        for attempt in range(self.retries + 1):
+            if start + plan.done[i] > end:
+                return
+            try:
+                async with aiofiles.open(part_path, "r+b") as f:
+                    await f.seek(start + plan.done[i])
+                    async with self.client.stream(
+                        "GET",
+                        url,
+                        headers={**headers, "Range": f"bytes={start + plan.done[i]}-{end}"},
+                    ) as resp:
+                        if resp.status_code != 206:
+                            raise httpx.HTTPStatusError(
+                                f"分段请求返回 {resp.status_code}",
+                                request=resp.request,
+                                response=resp,
+                            )
+                        async for chunk in resp.aiter_bytes():
+                            chunk = chunk[: end + 1 - start - plan.done[i]]
+                            await self._throttle(len(chunk))
+                            await f.write(chunk)
+                            plan.done[i] += len(chunk)
+                            tracker.advance(len(chunk))
+                if start + plan.done[i] > end:
+                    return
+                raise httpx.ReadError("分段数据不完整")
+            except (httpx.HTTPError, OSError) as e:
+                if attempt == self.retries or not _retryable(e):
+                    raise
+                await self._sleep_backoff(
+                    attempt, f"第{i + 1}段下载失败（{e}），将从 {start + plan.done[i]} 处重试"
+                )
+
+    async def _throttle(self, size: int):
+        if self.limiter is not None:
+            await self.limiter.acquire(size)
+
+    async def _sleep_backoff(self, attempt: int, reason: str):
+        """指数退避加随机抖动"""
+        delay = self.backoff * 2**attempt * (1 + random.random())
+        logger.warning(f"{reason}，{delay:.1f}秒后重试")
+        await asyncio.sleep(delay)
+
+
+def _retryable(error: Exception) -> bool:
+    """
+    网络错误、5xx 和限流值得重试；403/404 等说明链接已失效或无权访问，重试也没用。
+    本地文件读写错误沿用原来的做法重试
+    """
+    if isinstance(error, OSError):
+        return True
+    return is_retryable(error)
+
+
+def remove_stale_partials(directory: str, max_age: float = PARTIAL_MAX_AGE) -> int:
+    """
+    删除目录中超过 max_age 秒没有续传的下载残留文件（.part 和 .part.state），返回删除的数量。
+    会扫描目录，在线程中执行
+    """
+    stale_before = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(directory):
+        if not entry.name.endswith((".part", ".part.state")) or not entry.is_file():
+            continue
+        try:
+            if entry.stat().st_mtime < stale_before:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def _scatter_write(
+    f: BinaryIO,
+    extents: list[tuple[int, int, int]],
+    starts: list[int],
+    offset: int,
+    data: bytes,
+):
+    """把源偏移 offset 处的 data 按 extents 写到输出文件中对应的位置，可能跨越多个区间"""
+    k = bisect.bisect_right(starts, offset) - 1
+    view = memoryview(data)
+    while view:
+        start, end, dst = extents[k]
+        n = min(len(view), end + 1 - offset)
+        f.seek(dst + offset - start)
+        f.write(view[:n])
+        offset += n
+        view = view[n:]
+        k += 1
+
+
+def _total_size(resp: "httpx.Response") -> int | None:
+    """从 206 响应的 Content-Range 中取文件总大小"""
+    content_range = resp.headers.get("content-range", "")
+    if resp.status_code == 206 and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    return None
+
+
+class _Progress:
+    """汇总各段的下载进度"""
+    def __init__(
+        self, total: int, current: int, callback: Callable[[int, int], None] | None
+    ):
+        self.total = total
+        self.current = current
+        self.callback = callback
+
+    def advance(self, n: int):
+        self.current += n
+        if self.callback is not None:
+            self.callback(self.current, self.total)
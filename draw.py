@@ -1,20 +1,346 @@
 import asyncio
-import aiohttp
-import aiofiles
+import hashlib
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
+from typing import TYPE_CHECKING
 from io import BytesIO
-from bs4 import BeautifulSoup
-import hashlib
 from astrbot import logger
+from .cache import SingleFlight, TTLCache
+from .client import HttpClient
+from .thumbnail import ThumbnailCache
+from .metrics import metrics
+from .models import VideoItem
+
+if TYPE_CHECKING:
+    # PIL 在首次渲染时才导入，加快插件加载
+    from PIL import Image, ImageDraw, ImageFont
 
 font_path = (
     Path(__file__).resolve().parent / "hei.TTF"
 )
 
+# 封面占位色
+PLACEHOLDER_COLOR = "#c9ccd0"
+
+# 按体积预算降低画质时的最低画质
+MIN_QUALITY = 30
+
+
+@dataclass(frozen=True)
+class CardLayout:
+    """卡片布局参数，会被传给渲染进程，因此只包含可序列化的简单字段"""
+    font_path: str
+    card_width: int = 300
+    card_height: int = 250
+    thumb_height: int = 168
+    margin: int = 16
+    corner_radius: int = 10
+    font_size: int = 16
+
+
+@dataclass(frozen=True)
+class ImageEncoding:
+    """菜单图的编码参数，同样会被传给渲染进程"""
+    # jpeg 或 webp
+    format: str = "jpeg"
+    quality: int = 70
+    # 编码后的体积上限（字节），超出时降低画质重新编码，0 表示固定画质
+    max_bytes: int = 0
+
+
+@lru_cache(maxsize=1)
+def webp_supported() -> bool:
+    """当前 Pillow 是否编译了 WebP 支持，不支持时只提示一次"""
+    from PIL import features
+
+    if features.check("webp"):
+        return True
+    logger.warning("当前 Pillow 不支持 WebP，菜单图改用 JPEG 编码")
+    return False
+
+
+def encode_image(canvas: "Image.Image", encoding: ImageEncoding) -> bytes:
+    """
+    按编码参数保存菜单图，JPEG 使用渐进式编码和优化的哈夫曼表。
+    设置了体积上限时，在 [MIN_QUALITY, quality] 间二分查找放得下的最高画质，
+    都放不下时返回最小的结果
+    """
+    webp = encoding.format == "webp" and webp_supported()
+
+    def save(quality: int) -> bytes:
+        buffer = BytesIO()
+        if webp:
+            canvas.save(buffer, format="WEBP", quality=quality)
+        else:
+            canvas.save(
+                buffer, format="JPEG", quality=quality, optimize=True, progressive=True
+            )
+        return buffer.getvalue()
+
+    data = save(encoding.quality)
+    if not encoding.max_bytes or len(data) <= encoding.max_bytes:
+        return data
+    best: bytes | None = None
+    smallest = data
+    low, high = MIN_QUALITY, encoding.quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = save(quality)
+        if len(candidate) <= encoding.max_bytes:
+            best = candidate
+            low = quality + 1
+        else:
+            smallest = min(smallest, candidate, key=len)
+            high = quality - 1
+    return best if best is not None else smallest
+
+
+def menu_key(
+    video_list: list[VideoItem],
+    cards_per_row: int,
+    layout: CardLayout,
+    encoding: ImageEncoding,
+) -> str:
+    """菜单图的内容哈希：卡片上绘制的全部字段，加上布局和编码参数"""
+    digest = hashlib.sha1(repr((cards_per_row, layout, encoding)).encode())
+    for video in video_list:
+        digest.update(
+            repr(
+                (video.bvid, video.title, video.author, video.play, video.duration, video.cover)
+            ).encode()
+        )
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=8)
+def load_font(path: str, size: int) -> "ImageFont.FreeTypeFont":
+    """加载字体，每个进程内同一字号只加载一次"""
+    from PIL import ImageFont
+
+    return ImageFont.truetype(path, size)
+
+
+@lru_cache(maxsize=2048)
+def text_mask(font_path: str, size: int, text: str) -> tuple["Image.Image", tuple[int, int]]:
+    """
+    单行文字的灰度遮罩及其相对绘制坐标的偏移。播放量、时长、序号和UP主名大量重复，
+    缓存后同样的文字只排版和栅格化一次，贴到画布上的结果与 ImageDraw.text 逐像素相同
+    """
+    from PIL import Image, ImageDraw
+
+    font = load_font(font_path, size)
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new("L", (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font)
+    return mask, (left, top)
+
+
+def draw_text(
+    canvas: "Image.Image", layout: CardLayout, xy: tuple[int, int], text: str, fill: str
+):
+    """用缓存的文字遮罩在画布上绘制单行文字"""
+    mask, (dx, dy) = text_mask(layout.font_path, layout.font_size, text)
+    x, y = xy[0] + dx, xy[1] + dy
+    canvas.paste(fill, (x, y, x + mask.width, y + mask.height), mask)
+
+
+def format_count(count: int) -> str:
+    if count >= 10000:
+        return f"{count / 10000:.1f}万"
+    elif count >= 1000:
+        return f"{count / 1000:.1f}千"
+    return str(count)
+
+
+@dataclass(frozen=True)
+class CardLayers:
+    """同一布局下所有卡片共用的静态图层"""
+    # 整张卡片的圆角遮罩
+    corner_mask: "Image.Image"
+    # 封面区域的圆角遮罩（卡片遮罩的上半部分）
+    thumb_mask: "Image.Image"
+    # 封面底部的渐变黑遮罩
+    gradient_mask: "Image.Image"
+
+
+@lru_cache(maxsize=8)
+def build_layers(layout: CardLayout) -> CardLayers:
+    """按布局构建静态图层，同一布局只构建一次"""
+    from PIL import Image, ImageDraw
+
+    corner_mask = Image.new("L", (layout.card_width, layout.card_height), 0)
+    ImageDraw.Draw(corner_mask).rounded_rectangle(
+        (0, 0, layout.card_width, layout.card_height),
+        radius=layout.corner_radius,
+        fill=255,
+    )
+    thumb_mask = corner_mask.crop((0, 0, layout.card_width, layout.thumb_height))
+
+    # 渐变只随 y 变化，先画一列再横向拉伸
+    gradient_height = 40
+    gradient_column = Image.new("L", (1, gradient_height))
+    gradient_column.putdata(
+        [int(180 * (y / gradient_height)) for y in range(gradient_height)]
+    )
+    gradient_mask = gradient_column.resize(
+        (layout.card_width, gradient_height), Image.Resampling.NEAREST
+    )
+    return CardLayers(corner_mask, thumb_mask, gradient_mask)
+
+
+@lru_cache(maxsize=16)
+def build_background(
+    layout: CardLayout, cards_per_row: int, card_count: int
+) -> "Image.Image":
+    """构建画布模板：背景色加上所有空白圆角卡片，同一布局和卡片数只构建一次"""
+    from PIL import Image
+
+    rows = (card_count + cards_per_row - 1) // cards_per_row
+    width = cards_per_row * layout.card_width + (cards_per_row + 1) * layout.margin
+    height = rows * (layout.card_height + 2 * layout.margin)
+    background = Image.new("RGB", (width, height), "#f5f5f5")
+    corner_mask = build_layers(layout).corner_mask
+    for i in range(card_count):
+        background.paste("#ffffff", card_origin(layout, cards_per_row, i), corner_mask)
+    return background
+
+
+def card_origin(layout: CardLayout, cards_per_row: int, i: int) -> tuple[int, int]:
+    """第 i 张卡片在画布上的左上角坐标"""
+    row, col = divmod(i, cards_per_row)
+    x = layout.margin + col * (layout.card_width + layout.margin)
+    y = layout.margin + row * (layout.card_height + 2 * layout.margin)
+    return x, y
+
+
+def draw_card(
+    canvas: "Image.Image",
+    draw: "ImageDraw.ImageDraw",
+    layout: CardLayout,
+    origin: tuple[int, int],
+    video: VideoItem,
+    thumb: "Image.Image | None",
+    font: "ImageFont.FreeTypeFont",
+    index: int,
+):
+    """把单张卡片直接绘制到画布上（同步，在渲染线程/进程中执行）"""
+    layers = build_layers(layout)
+    x, y = origin
+    try:
+        # 封面，未能按时获取的用纯色占位，文字照常绘制
+        if thumb is None:
+            canvas.paste(
+                PLACEHOLDER_COLOR,
+                (x, y, x + layout.card_width, y + layout.thumb_height),
+                layers.thumb_mask,
+            )
+        else:
+            canvas.paste(thumb, (x, y), layers.thumb_mask)
+
+        # 渐变黑图层
+        gradient_height = layers.gradient_mask.height
+        canvas.paste(
+            (0, 0, 0),
+            (
+                x,
+                y + layout.thumb_height - gradient_height,
+                x + layout.card_width,
+                y + layout.thumb_height,
+            ),
+            layers.gradient_mask,
+        )
+
+        # 播放量
+        draw_text(
+            canvas,
+            layout,
+            (x + 8, y + layout.thumb_height - 20),
+            format_count(video.play),
+            "#ffffff",
+        )
+
+        # 时长
+        draw_text(
+            canvas,
+            layout,
+            (x + layout.card_width - 40, y + layout.thumb_height - 20),
+            video.duration_text,
+            "#ffffff",
+        )
+
+        # 标题，每张卡片都不同，不缓存
+        raw_title = video.title
+        title = (
+            raw_title[:18] + "\n" + raw_title[18:36] + "..."
+            if len(raw_title) > 36
+            else raw_title[:18] + "\n" + raw_title[18:]
+        )
+        draw.text((x + 8, y + layout.thumb_height + 8), title, font=font, fill="#000000")
+
+        # 作者
+        draw_text(
+            canvas,
+            layout,
+            (x + 8, y + layout.thumb_height + 60),
+            f"UP {video.author}",
+            "#666666",
+        )
+
+        # 序号
+        draw_text(
+            canvas,
+            layout,
+            (
+                x + layout.card_width - 30,
+                y + layout.card_height - 20,
+            ),
+            str(index),
+            "#666666",
+        )
+    except Exception as e:
+        logger.error(f"[错误] 渲染卡片失败: {e}")
+        # 恢复为空白卡片以避免中断整个流程
+        canvas.paste(
+            "#ffffff",
+            (x, y, x + layout.card_width, y + layout.card_height),
+            layers.corner_mask,
+        )
+
+
+def render_menu(
+    layout: CardLayout,
+    video_list: list[VideoItem],
+    thumbs: "list[Image.Image | None]",
+    cards_per_row: int,
+    encoding: ImageEncoding,
+) -> tuple[bytes, float, float]:
+    """
+    绘制并编码整张菜单图（同步，在渲染线程/进程中执行），
+    返回 (图片数据, 绘制耗时, 编码耗时)。耗时随结果返回，渲染进程中无法直接记录指标
+    """
+    from PIL import ImageDraw
+
+    start = time.perf_counter()
+    font = load_font(layout.font_path, layout.font_size)
+    # 所有卡片直接画在 RGB 画布上，不生成单张卡片和每行的中间图
+    canvas = build_background(layout, cards_per_row, len(video_list)).copy()
+    draw = ImageDraw.Draw(canvas)
+    for i, (video, thumb) in enumerate(zip(video_list, thumbs)):
+        origin = card_origin(layout, cards_per_row, i)
+        draw_card(canvas, draw, layout, origin, video, thumb, font, index=i + 1)
+
+    drawn = time.perf_counter()
+    image = encode_image(canvas, encoding)
+    return image, drawn - start, time.perf_counter() - drawn
+
+
 class VideoCardRenderer:
     def __init__(
         self,
+        client: HttpClient,
         font_path: Path = font_path,
         cache_dir: Path = Path("image_cache"),
         card_width: int = 300,
@@ -23,192 +349,137 @@ class VideoCardRenderer:
         margin: int = 16,
         corner_radius: int = 10,
         max_concurrency: int = 10,
+        memory_cache_items: int = 256,
+        disk_cache_quota: int = 64 * 1024 * 1024,
+        disk_cache_max_age: float = 7 * 24 * 3600,
+        executor: str = "thread",
+        render_workers: int = 2,
+        max_concurrent_renders: int = 2,
+        cover_deadline: float = 2.0,
+        cover_timeout: float = 10.0,
+        menu_cache_items: int = 32,
+        image_format: str = "jpeg",
+        image_quality: int = 70,
+        image_max_bytes: int = 0,
     ):
-        self.font_path = font_path
-        self.cache_dir = cache_dir
-        self.card_width = card_width
-        self.card_height = card_height
-        self.thumb_height = thumb_height
-        self.margin = margin
-        self.corner_radius = corner_radius
+        self.client = client
+        self.layout = CardLayout(
+            font_path=str(font_path),
+            card_width=card_width,
+            card_height=card_height,
+            thumb_height=thumb_height,
+            margin=margin,
+            corner_radius=corner_radius,
+        )
         self.semaphore = asyncio.Semaphore(max_concurrency)
-        self.cache_dir.mkdir(parents=True, exist_ok=True)
-
-    def _get_cache_path(self, url: str) -> Path:
-        # 生成唯一文件名
-        name = hashlib.md5(url.encode()).hexdigest() + ".jpg"
-        return self.cache_dir / name
+        # 封面缓存，存放已缩放到卡片尺寸的图片
+        self.thumb_cache = ThumbnailCache(
+            cache_dir,
+            size=(card_width, thumb_height),
+            memory_items=memory_cache_items,
+            disk_quota=disk_cache_quota,
+            max_age=disk_cache_max_age,
+        )
+        # 渲染池：PIL 操作都在池中执行，事件循环只负责网络 I/O
+        self.executor: Executor = (
+            ProcessPoolExecutor(max_workers=render_workers)
+            if executor == "process"
+            else ThreadPoolExecutor(
+                max_workers=render_workers, thread_name_prefix="video_card_render"
+            )
+        )
+        # 同时进行的渲染数上限
+        self.render_semaphore = asyncio.Semaphore(max_concurrent_renders)
+        # 每张菜单等待封面的时间预算，超时的封面使用占位图
+        self.cover_deadline = cover_deadline
+        # 单张封面的请求超时，防止卡住的图床一直占用下载名额
+        self.cover_timeout = cover_timeout
+        # 超出预算仍在下载的封面，完成后写入缓存供下次使用
+        self._late_fetches: set[asyncio.Task] = set()
+        # 菜单图编码参数
+        self.encoding = ImageEncoding(image_format, image_quality, image_max_bytes)
+        # 已渲染的菜单图，按内容哈希缓存，热门关键词在多个群里搜索时不必重画
+        self.menu_cache = TTLCache(menu_cache_items, ttl=None)
+        # 合并同一张菜单的并发渲染
+        self._render_flight = SingleFlight()
 
-    async def download_image(
-        self, url: str, session: aiohttp.ClientSession
-    ) -> Image.Image:
-        cache_path = self._get_cache_path(url)
-        if cache_path.exists():
-            return Image.open(cache_path).convert("RGB")
+    async def download_image(self, url: str) -> "Image.Image":
+        """获取已缩放到卡片尺寸的封面"""
+        thumb = await self.thumb_cache.get(url)
+        if thumb is not None:
+            return thumb
 
         async with self.semaphore:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    img_bytes = await resp.read()
-                    async with aiofiles.open(cache_path, "wb") as f:
-                        await f.write(img_bytes)
-                    return Image.open(BytesIO(img_bytes)).convert("RGB")
+            with metrics.timer("cover_fetch"):
+                resp = await self.client.get(url, timeout=self.cover_timeout)
+                if resp.status_code == 200:
+                    return await self.thumb_cache.put(url, resp.content)
                 raise ValueError(f"下载失败: {url}")
 
-    def format_count(self, count: int) -> str:
-        if count >= 10000:
-            return f"{count / 10000:.1f}万"
-        elif count >= 1000:
-            return f"{count / 1000:.1f}千"
-        return str(count)
-
-    async def draw_card(
-        self,
-        video: dict,
-        font: ImageFont.FreeTypeFont,
-        session: aiohttp.ClientSession,
-        index: int,
-    ) -> Image.Image:
+    async def fetch_thumb(self, video: VideoItem) -> "Image.Image | None":
+        """获取某个视频的封面，失败返回 None"""
         try:
-            card = Image.new("RGBA", (self.card_width, self.card_height), "#ffffff")
-            draw = ImageDraw.Draw(card)
-
-            # 封面
-            raw_url = video.get("pic", "")
-            pic_url = (
-                raw_url
-                if raw_url.startswith("http")
-                else ("https:" + raw_url)
-            )
-            thumb = await self.download_image(pic_url, session)
-            thumb = thumb.resize((self.card_width, self.thumb_height))
-            card.paste(thumb, (0, 0))
-
-            # 渐变黑图层
-            gradient_height = 40
-            alpha_gradient = Image.new("L", (self.card_width, gradient_height), color=0)
-            for y in range(gradient_height):
-                alpha = int(180 * (y / gradient_height))
-                ImageDraw.Draw(alpha_gradient).line(
-                    [(0, y), (self.card_width, y)], fill=alpha
-                )
-            overlay = Image.new(
-                "RGBA", (self.card_width, gradient_height), color=(0, 0, 0, 255)
-            )
-            overlay.putalpha(alpha_gradient)
-            card.paste(overlay, (0, self.thumb_height - 40), overlay)
-
-            # 播放量
-            draw.text(
-                (8, self.thumb_height - 20),
-                f"{self.format_count(video['play'])}",
-                font=font,
-                fill="#ffffff",
-            )
-
-            # 时长
-            draw.text(
-                (self.card_width - 40, self.thumb_height - 20),
-                f"{video['duration']}",
-                font=font,
-                fill="#ffffff",
-            )
-
-            # 标题
-            raw_title = BeautifulSoup(video["title"], "html.parser").get_text()
-            title = (
-                raw_title[:18] + "\n" + raw_title[18:36] + "..."
-                if len(raw_title) > 36
-                else raw_title[:18] + "\n" + raw_title[18:]
-            )
-            draw.text((8, self.thumb_height + 8), title, font=font, fill="#000000")
-
-            # 作者
-            draw.text(
-                (8, self.thumb_height + 60),
-                f"UP {video['author']}",
-                font=font,
-                fill="#666666",
-            )
-
-            # 序号
-            draw.text(
-                (
-                    self.card_width - 30,
-                    self.card_height - 20,
-                ),
-                str(index),
-                font=font,
-                fill="#666666",
-            )
-
-            # 创建圆角遮罩
-            mask = Image.new("L", (self.card_width, self.card_height), 0)
-            draw_mask = ImageDraw.Draw(mask)
-            draw_mask.rounded_rectangle(
-                (0, 0, self.card_width, self.card_height),
-                radius=self.corner_radius,
-                fill=255,
-            )
-            # 应用圆角遮罩
-            card.putalpha(mask)
-
-            return card
+            return await self.download_image(video.cover)
         except Exception as e:
-            logger.error(f"[错误] 渲染卡片失败: {e}")
-            # 返回空白卡片以避免中断整个流程
-            return Image.new("RGBA", (self.card_width, self.card_height), "#ffffff")
+            logger.error(f"[错误] 获取封面失败: {e}")
+            return None
+
+    async def fetch_thumbs(self, video_list: list[VideoItem]) -> "list[Image.Image | None]":
+        """
+        在时间预算内并发获取所有封面，超时未到的封面返回 None，
+        它们会在后台继续下载并写入缓存
+        """
+        tasks = [asyncio.create_task(self.fetch_thumb(video)) for video in video_list]
+        if not tasks:
+            return []
+        _, pending = await asyncio.wait(tasks, timeout=self.cover_deadline)
+        if pending:
+            logger.debug(f"{len(pending)} 张封面超出时间预算，使用占位图")
+            metrics.error("cover_deadline")
+        for task in pending:
+            self._late_fetches.add(task)
+            task.add_done_callback(self._late_fetches.discard)
+        return [None if task in pending else task.result() for task in tasks]
 
     async def render_video_list_image(
-        self,
-        video_list: list,
-        cards_per_row: int = 3,
-        quality: int = 70
+        self, video_list: list[VideoItem], cards_per_row: int = 3
     ) -> bytes:
-        font = ImageFont.truetype(self.font_path, 16)
-
-        async with aiohttp.ClientSession() as session:
-            tasks = [
-                self.draw_card(video, font, session, index=i + 1)
-                for i, video in enumerate(video_list)
-            ]
-            cards = await asyncio.gather(*tasks)
-
-        # 拼接每一行（分层）
-        rows = []
-        for i in range(0, len(cards), cards_per_row):
-            row_cards = cards[i : i + cards_per_row]
-            row_width = (
-                cards_per_row * self.card_width + (cards_per_row + 1) * self.margin
-            )
-            row_img = Image.new(
-                "RGBA",
-                (row_width, self.card_height + 2 * self.margin),
-                color="#f5f5f5",
-            )
-            for j, card in enumerate(row_cards):
-                x = self.margin + j * (self.card_width + self.margin)
-                row_img.paste(card, (x, self.margin), card)
-            rows.append(row_img)
-
-        # 最终拼接所有行
-        total_width = rows[0].width
-        total_height = sum(r.height for r in rows)
-        canvas = Image.new(
-            "RGBA",
-            (total_width, total_height),
-            color="#f5f5f5",
+        """渲染菜单图，内容相同的菜单直接使用缓存"""
+        key = menu_key(video_list, cards_per_row, self.layout, self.encoding)
+        image = self.menu_cache.get(key)
+        if image is not None:
+            return image
+        return await self._render_flight.do(
+            key, lambda: self._render(key, video_list, cards_per_row)
         )
 
-        y_offset = 0
-        for row in rows:
-            canvas.paste(row, (0, y_offset), row)
-            y_offset += row.height
-
-        # 异步保存 JPEG，降画质
-        final_image = Image.new("RGB", canvas.size, "#f5f5f5")
-        final_image.paste(canvas, mask=canvas.split()[3])
+    async def _render(
+        self, key: str, video_list: list[VideoItem], cards_per_row: int
+    ) -> bytes:
+        thumbs = await self.fetch_thumbs(video_list)
+        async with self.render_semaphore:
+            loop = asyncio.get_running_loop()
+            image, draw_seconds, encode_seconds = await loop.run_in_executor(
+                self.executor,
+                render_menu,
+                self.layout,
+                video_list,
+                thumbs,
+                cards_per_row,
+                self.encoding,
+            )
+        metrics.observe("render", draw_seconds)
+        metrics.observe("image_encode", encode_seconds)
+        # 有封面用了占位图时不缓存，下次渲染可以用上已下载好的封面
+        if None not in thumbs:
+            self.menu_cache.set(key, image)
+        return image
 
-        buffer = BytesIO()
-        final_image.save(buffer, format="JPEG", quality=quality)
-        return buffer.getvalue()
+    async def close(self):
+        """取消并等待进行中的渲染和后台封面下载，关闭渲染池"""
+        await self._render_flight.cancel_all()
+        tasks = list(self._late_fetches)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,197 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, TypeVar
+from astrbot import logger
+from .limiter import TokenBucket
+
+T = TypeVar("T")
+
+# 可重试的 HTTP 状态码：412 为B站风控，429 为请求过多
+RETRYABLE_STATUS = {412, 429}
+
+# 可重试的B站接口错误码：-352 风控校验失败，-412 请求被拦截，-509/-799 请求过于频繁
+RETRYABLE_CODES = {-352, -412, -509, -799}
+
+# 熔断器状态，数值用于导出指标
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+
+class ApiError(Exception):
+    """B站接口返回了非 0 的 code"""
+    def __init__(self, code: int, message: str = ""):
+        super().__init__(f"接口返回错误代码 {code}：{message}")
+        self.code = code
+
+
+class CircuitOpen(Exception):
+    """熔断器打开，请求未发出即被拒绝"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    判断错误是否值得重试：风控和限流（412/429、-352 等）、5xx 和网络错误。
+    兼容 httpx 的异常和 bilibili_api 的 ResponseCodeException / NetworkException
+    """
+    import httpx
+
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status in RETRYABLE_STATUS or status >= 500
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_CODES
+    status = getattr(error, "status", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS or status >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续 failure_threshold 次调用失败后打开，打开期间直接拒绝请求；
+    reset_timeout 秒后进入半开状态放行一个探测请求，成功则关闭，失败则重新打开。
+    探测请求被取消而没有结果时，再过 reset_timeout 秒会放行下一个探测
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        # 打开或开始探测的时间
+        self._since = 0.0
+        # 打开的次数
+        self.trips = 0
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if now - self._since < self.reset_timeout:
+            return False
+        self.state = HALF_OPEN
+        self._since = now
+        return True
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.trips += 1
+            self.state = OPEN
+            self._since = time.monotonic()
+
+
+class _Endpoint:
+    """单个接口的限速器、熔断器和计数"""
+    def __init__(self, rate: float, burst: float, failure_threshold: int, reset_timeout: float):
+        # rate 为 0 时不限速
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.calls = 0
+        # 因限速而等待的请求数
+        self.throttled = 0
+        self.retries = 0
+        self.failures = 0
+        # 熔断期间被直接拒绝的请求数
+        self.rejected = 0
+
+    def stats(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "trips": self.breaker.trips,
+            "calls": self.calls,
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class RequestGovernor:
+    """
+    B站接口请求的统一管控：每个接口一个令牌桶限速，遇到风控、限流、5xx 和网络错误时
+    按指数退避加随机抖动重试，重试用尽的调用计入熔断器，熔断期间直接抛出 CircuitOpen
+    """
+    def __init__(
+        self,
+        rate: float = 3,
+        burst: float | None = None,
+        retries: int = 2,
+        backoff: float = 1.0,
+        max_backoff: float = 10.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+    ):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate * 2
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._endpoints: dict[str, _Endpoint] = {}
+
+    def _endpoint(self, name: str) -> _Endpoint:
+        endpoint = self._endpoints.get(name)
+        if endpoint is None:
+            endpoint = self._endpoints[name] = _Endpoint(
+                self.rate, self.burst, self.failure_threshold, self.reset_timeout
+            )
+        return endpoint
+
+    async def call(
+        self, name: str, request: Callable[[], Awaitable[T]], speculative: bool = False
+    ) -> T:
+        """
+        经限速、重试和熔断执行一次对接口 name 的请求，request 每次重试都会重新调用。
+        speculative 表示请求只是预先准备，可有可无：与正常请求共用令牌桶，
+        熔断器没有关闭时直接拒绝（也不占用半开时的探测名额），失败不重试，也不计入熔断
+        """
+        endpoint = self._endpoint(name)
+        if speculative and endpoint.breaker.state != CLOSED:
+            endpoint.rejected += 1
+            raise CircuitOpen(f"{name} 接口暂时熔断，跳过预先请求")
+        if not speculative and not endpoint.breaker.allow():
+            endpoint.rejected += 1
+            raise CircuitOpen(f"{name} 接口暂时熔断")
+        endpoint.calls += 1
+        attempt = 0
+        while True:
+            wait = endpoint.bucket.delay() if endpoint.bucket is not None else 0
+            if wait > 0:
+                endpoint.throttled += 1
+                await asyncio.sleep(wait)
+            try:
+                result = await request()
+            except Exception as e:
+                if not is_retryable(e):
+                    # 接口有正常响应，只是请求本身有问题，不计入熔断
+                    endpoint.breaker.record_success()
+                    raise
+                endpoint.failures += 1
+                if speculative:
+                    raise
+                if attempt >= self.retries:
+                    endpoint.breaker.record_failure()
+                    if endpoint.breaker.state == OPEN:
+                        logger.warning(f"{name} 接口连续失败，暂停请求 {self.reset_timeout:.0f} 秒")
+                    raise
+                endpoint.retries += 1
+                delay = min(self.max_backoff, self.backoff * 2**attempt) * (0.5 + random.random())
+                logger.warning(f"{name} 接口请求失败（{e}），{delay:.1f}秒后重试")
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                endpoint.breaker.record_success()
+                return result
+
+    def stats(self) -> dict:
+        """各接口的熔断状态（0 关闭，1 半开，2 打开）和限速、重试、拒绝计数"""
+        return {name: endpoint.stats() for name, endpoint in self._endpoints.items()}
@@ -0,0 +1,32 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶限速器：令牌按 rate 每秒匀速补充，最多积攒 capacity 个。
+    取令牌时先预支，余额为负就等到补足为止，因此并发的调用方按到达顺序排队，
+    单次取用超过桶容量也不会卡死
+    """
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float = 1) -> float:
+        """预支 amount 个令牌，返回需要等待的秒数"""
+        self._refill()
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    async def acquire(self, amount: float = 1):
+        """取 amount 个令牌，不足时等待"""
+        wait = self.delay(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
@@ -0,0 +1,166 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from astrbot import logger
+from .metrics import metrics
+
+# 最多保留的卡顿记录数
+MAX_RECORDS = 20
+
+# 记录的调用栈深度
+STACK_LIMIT = 25
+
+
+@dataclass
+class StallRecord:
+    """一次事件循环卡顿"""
+    # 发现卡顿的时间（time.time()）
+    at: float
+    # 卡顿时长（秒），循环恢复后才能确定
+    duration: float
+    # 卡顿时正在运行的任务及其协程
+    task: str
+    coroutine: str
+    # 调用栈中最内层的插件代码所属的插件，无法判断时为 unknown
+    plugin: str
+    # 最内层的插件代码位置，如 main.py:286 in send_video
+    location: str
+    stack: str
+
+
+def _plugin_of(filename: str) -> str | None:
+    """从文件路径中取插件目录名（AstrBot 的插件位于 .../plugins/<插件名>/ 下）"""
+    parts = os.path.normpath(filename).split(os.sep)
+    for i in range(len(parts) - 2, -1, -1):
+        if parts[i] == "plugins":
+            return parts[i + 1]
+    return None
+
+
+class LoopWatchdog:
+    """
+    事件循环卡顿检测：循环内的心跳协程每隔 threshold/4 秒更新一次时间戳，
+    后台线程发现心跳超过 threshold 秒未更新时，抓取事件循环线程的调用栈和当前任务，
+    按栈中最内层的插件代码归属到具体插件。循环恢复后由心跳记下实际卡顿时长，
+    写入日志和 loop_stall 指标。检测线程只读取栈帧，不影响事件循环
+    """
+    def __init__(self, threshold: float = 0.2):
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.records: deque[StallRecord] = deque(maxlen=MAX_RECORDS)
+        self.stalls = 0
+        self.max_stall = 0.0
+        self._beat = time.monotonic()
+        # 检测线程抓到的、尚未确定时长的卡顿
+        self._pending: StallRecord | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread_id = 0
+        self._task: asyncio.Task | None = None
+        # 开始检测的时间，未启动时为 None
+        self.started_at: float | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        """在事件循环中调用，启动心跳协程和检测线程"""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self.started_at = time.time()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._watch, name="search_video_loopwatch", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self.started_at = None
+        self._stop.set()
+
+    async def _heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._beat = now
+            record, self._pending = self._pending, None
+            if record is None:
+                continue
+            # 卡顿时长为心跳实际间隔超出预期的部分
+            record.duration = now - start - self.interval
+            if record.duration < self.threshold:
+                continue
+            self.stalls += 1
+            self.max_stall = max(self.max_stall, record.duration)
+            self.records.append(record)
+            metrics.observe("loop_stall", record.duration)
+            logger.warning(
+                f"事件循环卡顿 {record.duration * 1000:.0f}ms，插件 {record.plugin}，"
+                f"任务 {record.task}（{record.coroutine}），位置 {record.location}\n{record.stack}"
+            )
+
+    def _watch(self):
+        reported = False
+        while not self._stop.wait(self.interval):
+            stalled = time.monotonic() - self._beat > self.threshold
+            if stalled and not reported:
+                self._pending = self._capture()
+                reported = True
+            elif not stalled:
+                reported = False
+
+    def _capture(self) -> StallRecord:
+        """在检测线程中抓取事件循环线程当前的调用栈和正在运行的任务"""
+        frame = sys._current_frames().get(self._loop_thread_id)
+        summary = traceback.extract_stack(frame, limit=STACK_LIMIT) if frame else []
+        plugin, location = "unknown", "-"
+        if summary:
+            # 找不到插件代码时记录最内层的位置
+            location = f"{os.path.basename(summary[-1].filename)}:{summary[-1].lineno} in {summary[-1].name}"
+        for entry in reversed(summary):
+            name = _plugin_of(entry.filename)
+            if name is not None:
+                plugin = name
+                location = f"{os.path.basename(entry.filename)}:{entry.lineno} in {entry.name}"
+                break
+        task = asyncio.current_task(self._loop) if self._loop is not None else None
+        coroutine = task.get_coro() if task is not None else None
+        return StallRecord(
+            at=time.time(),
+            duration=0.0,
+            task=task.get_name() if task is not None else "-",
+            coroutine=getattr(coroutine, "__qualname__", "-"),
+            plugin=plugin,
+            location=location,
+            stack="".join(traceback.format_list(summary)),
+        )
+
+    def stats(self) -> dict:
+        return {"stalls": self.stalls, "max_stall_ms": self.max_stall * 1000}
+
+    def report(self) -> str:
+        """最近的卡顿记录，给管理员看"""
+        if not self.records:
+            if self.started_at is None:
+                return "事件循环卡顿检测尚未启动"
+            since = time.strftime("%m-%d %H:%M:%S", time.localtime(self.started_at))
+            return f"自 {since} 开始检测以来，未发现超过 {self.threshold * 1000:.0f}ms 的事件循环卡顿"
+        lines = [f"最近 {len(self.records)} 次事件循环卡顿（阈值 {self.threshold * 1000:.0f}ms）："]
+        for record in reversed(self.records):
+            lines.append(
+                f"{time.strftime('%m-%d %H:%M:%S', time.localtime(record.at))} "
+                f"{record.duration * 1000:.0f}ms {record.plugin} "
+                f"{record.coroutine} {record.location}"
+            )
+        return "\n".join(lines)
@@ -1,5 +1,6 @@
-import os
-from bs4 import BeautifulSoup
+import asyncio
+import aiofiles
+import aiofiles.os
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, StarTools, register
 from astrbot.core.config.astrbot_config import AstrBotConfig
@@ -8,6 +9,14 @@ from astrbot.core.utils.session_waiter import SessionController, session_waiter
 from astrbot import logger
 from .draw import VideoCardRenderer
 from .api import VideoAPI
+from .client import HttpClient
+from .downloader import remove_stale_partials
+from .store import VideoStore
+from .scheduler import DownloadScheduler, QueueFull
+from .governor import RequestGovernor
+from .loopwatch import LoopWatchdog
+from .metrics import metrics
+from .models import VideoItem
 
 @register(
     "astrbot_plugin_search_video",
@@ -21,25 +30,170 @@ class VideoPlugin(Star):
         super().__init__(context)
         # 哔哩哔哩限制的最大视频时长（默认8分钟），单位：秒
         self.max_duration: int = config.get("max_duration", 600)
+        # 超过最大时长的视频发送开头多少秒的预览，0 表示只发链接
+        self.preview_seconds: int = config.get("preview_seconds", 0)
         # B站cookie
         self.cookie: str = config.get("cookie", "")
+        # 共享的连接池客户端
+        self.http = HttpClient(
+            pool_size=config.get("pool_size", 20),
+            per_host_limit=config.get("per_host_limit", 8),
+            keepalive_expiry=config.get("keepalive_expiry", 30),
+            http2=config.get("http2", False),
+        )
+        # 视频缓存路径
+        self.plugin_data_dir = StarTools.get_data_dir("astrbot_plugin_search_video")
+        # 是否保存视频
+        self.is_save: bool = config.get("is_save", True)
+        # 正在发送的视频文件及其引用数，多个会话共用同一文件时最后一个发完才删除
+        self._sending: dict[str, int] = {}
+        # 视频库，按配额和保存天数淘汰旧视频
+        self.store = VideoStore(
+            self.plugin_data_dir,
+            quota=config.get("video_store_quota_mb", 2048) * 1024 * 1024,
+            max_age=config.get("video_store_max_age_days", 7) * 24 * 3600,
+            in_use=lambda path: path in self._sending,
+        )
         # 实例化api
-        self.api = VideoAPI(self.cookie)
+        self.api = VideoAPI(
+            self.cookie,
+            self.http,
+            search_cache_size=config.get("search_cache_size", 256),
+            search_cache_ttl=config.get("search_cache_ttl", 300),
+            store=self.store if self.is_save else None,
+            download_segments=config.get("download_segments", 4),
+            size_budget=config.get("size_budget_mb", 100) * 1024 * 1024,
+            scheduler=DownloadScheduler(
+                max_concurrent=config.get("max_concurrent_downloads", 2),
+                max_queue=config.get("download_queue_size", 20),
+                bandwidth_limit=config.get("download_speed_limit_kb", 0) * 1024,
+            ),
+            preresolve_concurrency=config.get("preresolve_concurrency", 2),
+            prewarm_bytes=config.get("prewarm_kb", 0) * 1024,
+            governor=RequestGovernor(
+                rate=config.get("api_rate_limit", 3),
+                retries=config.get("api_retries", 2),
+                reset_timeout=config.get("api_circuit_reset", 30),
+            ),
+        )
+        # 展示菜单后预解析前几个视频的下载链接，0 表示不预解析
+        self.preresolve_count: int = config.get("preresolve_count", 3)
+        # 是否在后台预取下一页搜索结果
+        self.prefetch_next_page: bool = config.get("prefetch_next_page", True)
         # 画图类
-        self.renderer = VideoCardRenderer()
+        self.renderer = VideoCardRenderer(
+            self.http,
+            cache_dir=self.plugin_data_dir / "image_cache",
+            memory_cache_items=config.get("thumb_memory_items", 256),
+            disk_cache_quota=config.get("thumb_disk_quota_mb", 64) * 1024 * 1024,
+            disk_cache_max_age=config.get("thumb_max_age_days", 7) * 24 * 3600,
+            executor=config.get("render_executor", "thread"),
+            render_workers=config.get("render_workers", 2),
+            max_concurrent_renders=config.get("max_concurrent_renders", 2),
+            cover_deadline=config.get("cover_deadline", 2.0),
+            menu_cache_items=config.get("menu_cache_items", 32),
+            image_format=config.get("image_format", "jpeg"),
+            image_quality=config.get("image_quality", 70),
+            image_max_bytes=config.get("image_max_kb", 0) * 1024,
+        )
         # 候选菜单的列数
         self.cards_per_row: int = config.get("cards_per_row", 18)
         # 超时时间
         self.timeout: int = config.get("timeout", 60)
-        # 是否保存视频
-        self.is_save: bool = config.get("is_save", True)
-        # 视频缓存路径
-        self.plugin_data_dir = StarTools.get_data_dir("astrbot_plugin_search_video")
+        # 缓存命中率、下载队列等统计随指标一起导出
+        metrics.add_collector("search_cache", self.api.search_stats)
+        metrics.add_collector("thumb_cache", self.renderer.thumb_cache.stats)
+        metrics.add_collector("menu_cache", self.renderer.menu_cache.stats)
+        metrics.add_collector("video_store", self.store.stats)
+        metrics.add_collector("stream_cache", self.api.stream_stats)
+        metrics.add_collector("download_queue", self.api.scheduler.stats)
+        metrics.add_collector("api", self.api.governor.stats)
+        # Prometheus 文本格式指标的导出文件（供 node_exporter textfile 收集），为空则不导出
+        self.metrics_file: str = config.get("metrics_file", "")
+        self._metrics_task: asyncio.Task | None = None
+        # 不保存视频时没有视频库的淘汰任务，由它定期清理下载残留文件
+        self._sweep_task: asyncio.Task | None = None
+        # 事件循环卡顿检测的阈值（毫秒），为 0 则不检测
+        threshold_ms = config.get("loop_stall_threshold_ms", 0)
+        self.watchdog = LoopWatchdog(threshold_ms / 1000) if threshold_ms > 0 else None
+        if self.watchdog is not None:
+            metrics.add_collector("event_loop", self.watchdog.stats)
+
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("视频统计")
+    async def metrics_handle(self, event: AstrMessageEvent):
+        """查看各阶段耗时和缓存命中率，加参数 prom 输出 Prometheus 格式，加参数 卡顿 查看事件循环卡顿记录"""
+        self._ensure_background_tasks()
+        arg = event.message_str.replace("视频统计", "").strip()
+        if arg == "prom":
+            yield event.plain_result(metrics.prometheus())
+        elif arg == "卡顿":
+            yield event.plain_result(
+                self.watchdog.report() if self.watchdog else "未开启事件循环卡顿检测"
+            )
+        else:
+            yield event.plain_result(metrics.summary())
+
+    def _ensure_background_tasks(self):
+        """首次收到搜索或统计命令时（此时才有事件循环）启动指标导出、卡顿检测和残留文件清理"""
+        if self.metrics_file and self._metrics_task is None:
+            self._metrics_task = asyncio.create_task(self._export_metrics_loop())
+        if not self.is_save and self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_partials_loop())
+        if self.watchdog is not None:
+            self.watchdog.start()
 
+    async def _sweep_partials_loop(self):
+        """定期删除长时间没有续传的下载残留文件，保存视频时由视频库的淘汰任务负责"""
+        while True:
+            try:
+                await asyncio.to_thread(remove_stale_partials, str(self.plugin_data_dir))
+            except OSError as e:
+                logger.warning(f"清理下载残留文件失败: {e}")
+            await asyncio.sleep(self.store.evict_interval)
+
+    async def _export_metrics_loop(self):
+        """定期把指标写入导出文件，先写临时文件再替换，避免被读到一半"""
+        tmp_path = self.metrics_file + ".tmp"
+        while True:
+            try:
+                text = metrics.prometheus()
+                async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+                    await f.write(text)
+                await aiofiles.os.replace(tmp_path, self.metrics_file)
+            except OSError as e:
+                logger.warning(f"导出指标失败: {e}")
+            await asyncio.sleep(60)
+
+    def _preresolve(self, video_list: list[VideoItem]) -> dict[str, asyncio.Task]:
+        """
+        用户选择期间预解析菜单前几个视频的下载链接，超长视频只发链接，跳过。
+        返回以 bvid 为键的预解析任务，会话结束时取消
+        """
+        if self.preresolve_count <= 0:
+            return {}
+        return self.api.preresolve(
+            [v for v in video_list if v.duration <= self.max_duration][
+                : self.preresolve_count
+            ]
+        )
+
+    @staticmethod
+    def _cancel_speculation(tasks: dict[str, asyncio.Task], keep: str | None = None):
+        """
+        取消本次会话还没完成的预解析。keep 为用户选中的视频，它的预解析继续运行，留给下载加入；
+        会话可能在下载进行时就已结束，所以它同时移出列表，之后的清理不会再取消它
+        """
+        for bvid, task in tasks.items():
+            if bvid != keep:
+                task.cancel()
+        tasks.clear()
 
     @filter.command("搜视频")
     async def search_video_handle(self, event: AstrMessageEvent):
         """搜索视频"""
+        self._ensure_background_tasks()
 
         # 获取用户输入的视频名称
         video_name = event.message_str.replace("搜视频", "")
@@ -48,16 +202,24 @@ class VideoPlugin(Star):
         video_list = await self.api.search_video(
             keyword=video_name, page=1
         )
+        if video_list is None:
+            yield event.plain_result("B站接口暂时不可用，请稍后再试")
+            return
         if not video_list:
             yield event.plain_result("没有找到相关视频")
             return
-        videos: list[list] = [video_list]
+        videos: list[list[VideoItem]] = [video_list]
+        # 用户浏览第1页时预取第2页
+        if self.prefetch_next_page:
+            self.api.prefetch_search(video_name, 2)
         # 展示搜索结果
         image: bytes = await self.renderer.render_video_list_image(
             videos[0],
             cards_per_row=self.cards_per_row,
         )
         await event.send(event.chain_result([Image.fromBytes(image)]))
+        # 本次会话发起的预解析，退出、选中或超时后取消
+        speculative = self._preresolve(videos[0])
 
         # 等待用户选择视频
         @session_waiter(timeout=self.timeout) # type: ignore
@@ -70,23 +232,31 @@ class VideoPlugin(Star):
             if input.startswith("页") and input[-1].isdigit():
                 # 重置超时时间
                 controller.keep(timeout=self.timeout, reset_timeout=True)
+                page = int(input[-1])
                 video_list_new = await self.api.search_video(
-                    keyword=video_name, page=int(input[-1])
+                    keyword=video_name, page=page
                 )
+                if video_list_new is None:
+                    await event.send(event.plain_result("B站接口暂时不可用，请稍后再试"))
+                    return
                 if not video_list_new:
                     await event.send(event.plain_result("没有找到更多相关视频"))
                     return
                 videos.append(video_list_new)
+                if self.prefetch_next_page:
+                    self.api.prefetch_search(video_name, page + 1)
                 image: bytes = await self.renderer.render_video_list_image(
                     video_list_new,
                     cards_per_row=self.cards_per_row,
                 )
                 await event.send(event.chain_result([Image.fromBytes(image)]))
+                speculative.update(self._preresolve(video_list_new))
                 return
 
             # 验证输入序号
             elif not input.isdigit() or int(input) < 1 or int(input) > len(videos[-1]):
                 await event.send(event.plain_result("已退出视频搜索！"))
+                self._cancel_speculation(speculative)
                 controller.stop()
                 return
 
@@ -94,24 +264,58 @@ class VideoPlugin(Star):
             controller.stop()
             # 获取视频信息
             video = videos[-1][int(input) - 1]
-            video_id: str = video.get("bvid", "")
-            raw_title = video["title"]
-            title = BeautifulSoup(raw_title, "html.parser").get_text()[0:9]
-            duration_str: str = video.get("duration", "0")
+            video_id = video.bvid
+            # 选中视频的预解析由下载接着等待，其余的不再需要
+            self._cancel_speculation(speculative, keep=video_id)
+            title = video.title[0:9]
+            duration = video.duration
+
+            async def notify_queued(position: int):
+                await event.send(
+                    event.plain_result(f"{title} 正在排队下载，当前排在第 {position + 1} 位")
+                )
 
-            # 视频时长是否超过最大时长时发链接，否则发送视频
-            duration = self.convert_duration_to_seconds(duration_str)
+            group = event.get_group_id() or event.get_sender_id()
+            # 视频时长超过最大时长时发链接（开启预览时附带开头片段），否则发送视频
             if duration > self.max_duration:
                 video_url = f"https://www.bilibili.com/video/{video_id}"
-                await event.send(event.plain_result(f"视频超过{self.max_duration/60}分钟改用链接：{video_url}"))
+                if self.preview_seconds <= 0:
+                    await event.send(event.plain_result(f"视频超过{self.max_duration/60}分钟改用链接：{video_url}"))
+                    return
+                await event.send(
+                    event.plain_result(
+                        f"视频超过{self.max_duration/60}分钟，发送前{self.preview_seconds}秒预览，"
+                        f"完整视频：{video_url}"
+                    )
+                )
+                logger.info(f"正在下载视频预览:{video.title}")
+                download = self.api.download_preview(
+                    video_id,
+                    str(self.plugin_data_dir),
+                    self.preview_seconds,
+                    group=group,
+                    notify=notify_queued,
+                )
             else:
                 await event.send(event.plain_result(f"正在下载 {title}..."))
-                logger.info(f"正在下载视频:{raw_title}")
-                data_path = await self.api.download_video(
-                    video_id, str(self.plugin_data_dir)
+                logger.info(f"正在下载视频:{video.title}")
+                download = self.api.download_video(
+                    video_id,
+                    str(self.plugin_data_dir),
+                    duration=duration,
+                    group=group,
+                    notify=notify_queued,
                 )
-                if data_path:
-                    await self.send_video(event, data_path)
+
+            try:
+                data_path = await download
+            except QueueFull:
+                await event.send(event.plain_result("下载任务太多，请稍后再试"))
+                return
+            if data_path:
+                await self.send_video(event, data_path)
+            else:
+                await event.send(event.plain_result(f"{title} 下载失败，请稍后再试"))
 
         try:
             await empty_mention_waiter(event)  # type: ignore
@@ -120,55 +324,57 @@ class VideoPlugin(Star):
         except Exception as e:
             logger.error("搜索视频发生错误" + str(e))
         finally:
+            self._cancel_speculation(speculative)
             event.stop_event()
 
     async def send_video(self, event: AstrMessageEvent, data_path: str):
         """发送视频"""
+        self._sending[data_path] = self._sending.get(data_path, 0) + 1
         try:
-            # 检测文件大小(如果视频大于 100 MB 自动转换为群文件)
-            file_size_mb = int(os.path.getsize(data_path) / (1024 * 1024))
-            if file_size_mb > 100:
-                if event.get_platform_name() == "aiocqhttp":
-                    from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import (
-                        AiocqhttpMessageEvent,
-                    )
-
-                    assert isinstance(event, AiocqhttpMessageEvent)
-                    client = event.bot
-                    group_id = event.get_group_id()
-                    name = data_path.split("/")[-1]
-                    if group_id:
-                        # 上传群文件
-                        await client.upload_group_file(
-                            group_id=group_id, file=data_path, name=name
+            with metrics.timer("send"):
+                # 检测文件大小(如果视频大于 100 MB 自动转换为群文件)
+                file_size_mb = int(await aiofiles.os.path.getsize(data_path) / (1024 * 1024))
+                if file_size_mb > 100:
+                    if event.get_platform_name() == "aiocqhttp":
+                        from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import (
+                            AiocqhttpMessageEvent,
                         )
-                    else:
-                        # 上传私聊文件
-                        await client.upload_private_file(
-                            user_id=int(event.get_sender_id()),
-                            file=data_path,
-                            name=name,
-                        )
-                    return
-            await event.send(event.chain_result([Video.fromFileSystem(data_path)]))
+
+                        assert isinstance(event, AiocqhttpMessageEvent)
+                        client = event.bot
+                        group_id = event.get_group_id()
+                        name = data_path.split("/")[-1]
+                        if group_id:
+                            # 上传群文件
+                            await client.upload_group_file(
+                                group_id=group_id, file=data_path, name=name
+                            )
+                        else:
+                            # 上传私聊文件
+                            await client.upload_private_file(
+                                user_id=int(event.get_sender_id()),
+                                file=data_path,
+                                name=name,
+                            )
+                        return
+                await event.send(event.chain_result([Video.fromFileSystem(data_path)]))
         except Exception as e:
             logger.error(f"解析发送出现错误，具体为\n{e}")
         finally:
-            if not self.is_save and os.path.exists(data_path):
-                os.unlink(data_path)
+            self._sending[data_path] -= 1
+            if self._sending[data_path] == 0:
+                del self._sending[data_path]
+                if not self.is_save and await aiofiles.os.path.exists(data_path):
+                    await aiofiles.os.unlink(data_path)
 
-    @staticmethod
-    def convert_duration_to_seconds(duration_str):
-        """将视频时长从 'HH:MM:SS'、'MM:SS' 或 'SS' 格式转换为秒"""
-        if not duration_str:
-            return 0
-        seconds = 0
-        parts = duration_str.split(":")
-        for i, part in enumerate(reversed(parts)):
-            if i == 0:
-                seconds += int(part)
-            elif i == 1:
-                seconds += int(part) * 60
-            elif i == 2:
-                seconds += int(part) * 3600
-        return seconds
+    async def terminate(self):
+        """插件卸载时取消后台任务，关闭渲染池和连接池"""
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        await self.api.close()
+        await self.renderer.close()
+        await self.http.close()
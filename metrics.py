@@ -0,0 +1,176 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable
+
+# 指标名前缀
+PREFIX = "search_video"
+
+# 各阶段耗时的分桶上限（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# 下载速度的分桶上限（字节/秒）
+RATE_BUCKETS = tuple(kb * 1024 for kb in (64, 256, 512, 1024, 2048, 5120, 10240, 20480, 51200))
+
+
+class Histogram:
+    """累计分桶直方图，格式与 Prometheus histogram 一致"""
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # counts[i] 为落在 (buckets[i-1], buckets[i]] 的次数，最后一个为 +Inf 桶
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """按分桶线性插值估算分位数"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else lower
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    请求各阶段的耗时直方图、吞吐量和错误计数。
+    只在事件循环线程中更新，不加锁；缓存命中率等已有统计通过收集函数在导出时读取
+    """
+    def __init__(self):
+        self.stages: dict[str, Histogram] = {}
+        self.errors: dict[str, int] = {}
+        self.download_rate = Histogram(RATE_BUCKETS)
+        self.download_bytes = 0
+        # 名称 -> 返回 {指标: 数值} 的函数
+        self._collectors: dict[str, Callable[[], dict]] = {}
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram(LATENCY_BUCKETS)
+        histogram.observe(seconds)
+
+    def error(self, stage: str):
+        self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    @contextmanager
+    def timer(self, stage: str):
+        """记录代码块的耗时，抛出异常时同时计一次该阶段的错误"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.error(stage)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe_download(self, size: int, seconds: float):
+        """记录一次流下载的字节数和平均速度"""
+        self.download_bytes += size
+        if seconds > 0:
+            self.download_rate.observe(size / seconds)
+
+    def add_collector(self, name: str, collect: Callable[[], dict]):
+        """注册一个统计来源，如缓存的 stats()，导出时读取其中的数值"""
+        self._collectors[name] = collect
+
+    def _collected(self) -> dict[str, dict]:
+        result = {}
+        for name, collect in self._collectors.items():
+            try:
+                result[name] = _flatten(collect())
+            except Exception:
+                result[name] = {}
+        return result
+
+    def summary(self) -> str:
+        """给管理员看的简要统计"""
+        lines = ["阶段耗时（次数 / 平均 / p50 / p95 / 错误）："]
+        for stage in sorted(set(self.stages) | set(self.errors)):
+            histogram = self.stages.get(stage, Histogram(LATENCY_BUCKETS))
+            average = histogram.sum / histogram.count if histogram.count else 0.0
+            lines.append(
+                f"  {stage}: {histogram.count} / {average * 1000:.0f}ms / "
+                f"{histogram.quantile(0.5) * 1000:.0f}ms / "
+                f"{histogram.quantile(0.95) * 1000:.0f}ms / {self.errors.get(stage, 0)}"
+            )
+        if self.download_rate.count:
+            lines.append(
+                f"下载：共 {self.download_bytes / 1024 / 1024:.1f}MB，"
+                f"速度 p50 {self.download_rate.quantile(0.5) / 1024:.0f}KB/s"
+            )
+        for name, values in self._collected().items():
+            text = "，".join(
+                f"{key} {value:.2f}" if isinstance(value, float) else f"{key} {value}"
+                for key, value in values.items()
+            )
+            lines.append(f"{name}：{text}")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        """Prometheus 文本格式的全部指标"""
+        lines = []
+        name = f"{PREFIX}_stage_seconds"
+        lines += [f"# HELP {name} 各阶段耗时", f"# TYPE {name} histogram"]
+        for stage, histogram in sorted(self.stages.items()):
+            lines += _histogram_lines(name, histogram, f'stage="{stage}"')
+
+        name = f"{PREFIX}_stage_errors_total"
+        lines += [f"# HELP {name} 各阶段错误数", f"# TYPE {name} counter"]
+        for stage, count in sorted(self.errors.items()):
+            lines.append(f'{name}{{stage="{stage}"}} {count}')
+
+        name = f"{PREFIX}_download_bytes_per_second"
+        lines += [f"# HELP {name} 单个流的平均下载速度", f"# TYPE {name} histogram"]
+        lines += _histogram_lines(name, self.download_rate, "")
+
+        name = f"{PREFIX}_download_bytes_total"
+        lines += [f"# HELP {name} 下载的总字节数", f"# TYPE {name} counter"]
+        lines.append(f"{name} {self.download_bytes}")
+
+        for source, values in self._collected().items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"{PREFIX}_{source}_{key} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(name: str, histogram: Histogram, labels: str) -> list[str]:
+    prefix = f"{labels}," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{name}_sum{suffix} {histogram.sum}")
+    lines.append(f"{name}_count{suffix} {histogram.count}")
+    return lines
+
+
+def _flatten(values: dict, prefix: str = "") -> dict:
+    """把嵌套的统计字典展开为 a_b 形式的键"""
+    result = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            result.update(_flatten(value, f"{prefix}{key}_"))
+        else:
+            result[f"{prefix}{key}"] = value
+    return result
+
+
+# 插件内共用的指标
+metrics = Metrics()
@@ -0,0 +1,77 @@
+import html
+import re
+from dataclasses import dataclass
+
+# 搜索结果标题中的高亮标签，如 <em class="keyword">
+_TAG_PATTERN = re.compile(r"<[^>]*>")
+
+
+def strip_html(text: str) -> str:
+    """去掉 HTML 标签并还原转义字符，结果与 BeautifulSoup(...).get_text() 相同"""
+    if "<" in text:
+        text = _TAG_PATTERN.sub("", text)
+    if "&" in text:
+        text = html.unescape(text)
+    return text
+
+
+def parse_duration(text: str) -> int:
+    """将 'HH:MM:SS'、'MM:SS' 或 'SS' 格式的时长转换为秒，无法解析时返回 0"""
+    seconds = 0
+    try:
+        for part in str(text).split(":"):
+            seconds = seconds * 60 + int(part)
+    except ValueError:
+        return 0
+    return seconds
+
+
+def format_duration(seconds: int) -> str:
+    """按B站搜索结果的样式显示时长，如 3:05、75:20"""
+    minutes, seconds = divmod(seconds, 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def normalize_url(url: str) -> str:
+    """补全B站接口返回的协议相对地址（//i0.hdslb.com/...）"""
+    if not url or url.startswith("http"):
+        return url
+    return "https:" + url if url.startswith("//") else "https://" + url
+
+
+@dataclass(slots=True)
+class VideoItem:
+    """
+    一条视频搜索结果。每次搜索响应只解析一次，缓存、会话和渲染都使用它，
+    不再保留接口返回的完整字典
+    """
+    bvid: str
+    # 去掉高亮标签后的标题
+    title: str
+    author: str
+    play: int
+    # 时长（秒）
+    duration: int
+    # 补全协议后的封面地址
+    cover: str
+
+    @classmethod
+    def from_result(cls, result: dict) -> "VideoItem":
+        play = result.get("play", 0)
+        return cls(
+            bvid=result.get("bvid", ""),
+            title=strip_html(result.get("title", "")),
+            author=result.get("author", ""),
+            play=play if isinstance(play, int) else 0,
+            duration=parse_duration(result.get("duration", "")),
+            cover=normalize_url(result.get("pic", "")),
+        )
+
+    @property
+    def duration_text(self) -> str:
+        return format_duration(self.duration)
+
+
+def parse_results(results: list[dict]) -> list[VideoItem]:
+    """把搜索接口的结果列表转换为 VideoItem 列表"""
+    return [VideoItem.from_result(result) for result in results]
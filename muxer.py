@@ -0,0 +1,500 @@
+import asyncio
+import bisect
+import os
+import platform
+import shutil
+import struct
+import subprocess
+from dataclasses import dataclass, field
+from typing import BinaryIO
+from astrbot import logger
+
+# 复制 mdat 时的缓冲区大小
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class MuxError(Exception):
+    """音视频合并失败"""
+
+
+@dataclass
+class _Box:
+    type: bytes
+    offset: int
+    size: int
+    header_size: int
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.size
+
+
+@dataclass
+class _Fragment:
+    """一个 moof + mdat 分片"""
+    moof: _Box
+    mdat: _Box
+    # 解码时间（秒），用于音视频分片交错排序
+    time: float
+
+
+@dataclass
+class _Stream:
+    """解析后的单轨分片 MP4（B站 DASH 的 m4s）"""
+    path: str
+    ftyp: bytes = b""
+    mvhd: bytes = b""
+    trak: bytes = b""
+    mehd: bytes = b""
+    trex: bytes = b""
+    # moov 中除 mvhd/trak/mvex 外的其余子盒子（如 udta）
+    extra: list[bytes] = field(default_factory=list)
+    timescale: int = 0
+    fragments: list[_Fragment] = field(default_factory=list)
+
+
+def _iter_boxes(f: BinaryIO, start: int, end: int):
+    """遍历 [start, end) 范围内的盒子，只读盒子头"""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(16)
+        size, box_type = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise MuxError(f"盒子 {box_type!r} 长度异常（偏移 {offset}）")
+        yield _Box(box_type, offset, size, header_size)
+        offset += size
+
+
+def _children(data: bytes) -> list[tuple[bytes, bytes]]:
+    """解析内存中容器盒子的负载，返回 (类型, 完整盒子字节) 列表"""
+    result = []
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack(">I4s", data[offset : offset + 8])
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8 : offset + 16])[0]
+        elif size == 0:
+            size = len(data) - offset
+        if size < 8 or offset + size > len(data):
+            raise MuxError(f"盒子 {box_type!r} 长度异常")
+        result.append((box_type, data[offset : offset + size]))
+        offset += size
+    return result
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+
+def _find(data: bytes, *path: bytes) -> bytes:
+    """按路径查找子盒子，返回完整盒子字节"""
+    for box_type in path:
+        for child_type, child in _children(data[8:]):
+            if child_type == box_type:
+                data = child
+                break
+        else:
+            raise MuxError(f"缺少 {box_type.decode()} 盒子")
+    return data
+
+
+def _set_track_id(box: bytes, track_id: int) -> bytes:
+    """修改 tkhd / trex / tfhd 中的 track_ID"""
+    box_type = box[4:8]
+    if box_type == b"tkhd":
+        # version 1 的创建/修改时间为 64 位
+        offset = 8 + 4 + (16 if box[8] == 1 else 8)
+    else:
+        offset = 8 + 4
+    return box[:offset] + struct.pack(">I", track_id) + box[offset + 4 :]
+
+
+def _retrack(container: bytes, track_id: int, targets: tuple[bytes, ...]) -> bytes:
+    """递归修改容器盒子中指定盒子的 track_ID"""
+    if container[4:8] in targets:
+        return _set_track_id(container, track_id)
+    children = _children(container[8:])
+    rebuilt = b"".join(
+        _retrack(child, track_id, targets)
+        if child_type in targets or child_type in (b"trak", b"traf")
+        else child
+        for child_type, child in children
+    )
+    return _box(container[4:8], rebuilt)
+
+
+@dataclass
+class SegmentIndex:
+    """sidx 盒子描述的子分段索引"""
+    # 第一个子分段在文件中的偏移
+    first_offset: int
+    # 每个子分段的 (字节数, 时长秒)
+    segments: list[tuple[int, float]]
+
+    def prefix(self, seconds: float) -> tuple[int, int, float]:
+        """覆盖开头至少 seconds 秒的子分段的字节区间 [起始, 结束]（闭区间）及其实际时长"""
+        size = 0
+        duration = 0.0
+        for segment_size, segment_duration in self.segments:
+            size += segment_size
+            duration += segment_duration
+            if duration >= seconds:
+                break
+        return self.first_offset, self.first_offset + size - 1, duration
+
+
+def parse_segment_index(head: bytes) -> SegmentIndex:
+    """从文件开头的数据（至少包含到 sidx 结束）中解析分段索引"""
+    offset = 0
+    for box_type, box in _children(head):
+        offset += len(box)
+        if box_type != b"sidx":
+            continue
+        version = box[8]
+        timescale = struct.unpack(">I", box[16:20])[0]
+        if version == 0:
+            first_offset = struct.unpack(">I", box[24:28])[0]
+            position = 28
+        else:
+            first_offset = struct.unpack(">Q", box[28:36])[0]
+            position = 36
+        count = struct.unpack(">H", box[position + 2 : position + 4])[0]
+        position += 4
+        if not timescale:
+            raise MuxError("sidx timescale 为 0")
+        segments = []
+        for _ in range(count):
+            reference, duration = struct.unpack(">II", box[position : position + 8])
+            if reference >> 31:
+                raise MuxError("不支持多级 sidx 索引")
+            segments.append((reference & 0x7FFFFFFF, duration / timescale))
+            position += 12
+        if not segments:
+            raise MuxError("sidx 中没有子分段")
+        # 子分段的偏移相对于 sidx 盒子的结尾
+        return SegmentIndex(offset + first_offset, segments)
+    raise MuxError("缺少 sidx 盒子")
+
+
+def _parse_stream(path: str) -> _Stream:
+    stream = _Stream(path)
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        pending_moof: _Box | None = None
+        for box in _iter_boxes(f, 0, file_size):
+            if box.type == b"ftyp":
+                f.seek(box.offset)
+                stream.ftyp = f.read(box.size)
+            elif box.type == b"moov":
+                f.seek(box.offset)
+                _parse_moov(stream, f.read(box.size))
+            elif box.type == b"moof":
+                pending_moof = box
+            elif box.type == b"mdat":
+                if not stream.timescale:
+                    raise MuxError("moov 不在分片之前")
+                if pending_moof is None or pending_moof.end != box.offset:
+                    raise MuxError("mdat 前没有紧邻的 moof，无法按分片复制")
+                f.seek(pending_moof.offset)
+                moof = f.read(pending_moof.size)
+                stream.fragments.append(
+                    _Fragment(pending_moof, box, _decode_time(moof) / stream.timescale)
+                )
+                pending_moof = None
+            # sidx / styp / free / mfra 等盒子直接丢弃
+    if not stream.trak:
+        raise MuxError(f"{os.path.basename(path)} 不是分片 MP4（缺少 moov/trak）")
+    if not stream.fragments:
+        raise MuxError(f"{os.path.basename(path)} 中没有 moof 分片")
+    return stream
+
+
+def _parse_moov(stream: _Stream, moov: bytes):
+    traks = []
+    for box_type, child in _children(moov[8:]):
+        if box_type == b"mvhd":
+            stream.mvhd = child
+        elif box_type == b"trak":
+            traks.append(child)
+        elif box_type == b"mvex":
+            for mvex_type, mvex_child in _children(child[8:]):
+                if mvex_type == b"mehd":
+                    stream.mehd = mvex_child
+                elif mvex_type == b"trex":
+                    stream.trex = mvex_child
+        else:
+            stream.extra.append(child)
+    if len(traks) != 1:
+        raise MuxError(f"每个输入应只包含一条轨道，实际为 {len(traks)} 条")
+    if not stream.trex:
+        raise MuxError("缺少 mvex/trex，不是分片 MP4")
+    stream.trak = traks[0]
+    mdhd = _find(stream.trak, b"mdia", b"mdhd")
+    # version 1 的创建/修改时间为 64 位
+    offset = 8 + 4 + (16 if mdhd[8] == 1 else 8)
+    stream.timescale = struct.unpack(">I", mdhd[offset : offset + 4])[0]
+    if not stream.timescale:
+        raise MuxError("轨道 timescale 为 0")
+
+
+def _decode_time(moof: bytes) -> int:
+    """取分片的 baseMediaDecodeTime，并确认分片内的数据偏移是相对 moof 的"""
+    traf = _find(moof, b"traf")
+    tfhd = _find(traf, b"tfhd")
+    flags = int.from_bytes(tfhd[9:12], "big")
+    if flags & 0x000001:
+        # base-data-offset 是文件绝对偏移，移动分片后会失效
+        raise MuxError("分片使用了绝对数据偏移，无法直接复制")
+    tfdt = _find(traf, b"tfdt")
+    if tfdt[8] == 1:
+        return struct.unpack(">Q", tfdt[12:20])[0]
+    return struct.unpack(">I", tfdt[12:16])[0]
+
+
+def _renumber_moof(moof: bytes, sequence: int, track_id: int) -> bytes:
+    """改写分片序号和 track_ID，盒子大小不变，因此 trun 的数据偏移仍然有效"""
+    parts = []
+    for box_type, child in _children(moof[8:]):
+        if box_type == b"mfhd":
+            child = child[:12] + struct.pack(">I", sequence) + child[16:]
+        elif box_type == b"traf":
+            child = _retrack(child, track_id, (b"tfhd",))
+        parts.append(child)
+    return _box(b"moof", b"".join(parts))
+
+
+def _copy_range(src: BinaryIO, dst: BinaryIO, offset: int, size: int, buffer: bytearray):
+    """把 src 中 [offset, offset + size) 追加到 dst，优先由内核直接复制"""
+    copied = _kernel_copy(src, dst, offset, size)
+    src.seek(offset + copied)
+    view = memoryview(buffer)
+    remaining = size - copied
+    while remaining:
+        n = src.readinto(view[: min(remaining, len(buffer))])
+        if not n:
+            raise MuxError("输入文件被截断")
+        dst.write(view[:n])
+        remaining -= n
+
+
+def _kernel_copy(src: BinaryIO, dst: BinaryIO, offset: int, size: int) -> int:
+    """
+    用 copy_file_range 在内核中复制，数据不经过用户态缓冲区，返回复制的字节数。
+    平台或文件系统不支持时停下，剩余部分由调用方用缓冲区复制
+    """
+    if not hasattr(os, "copy_file_range"):
+        return 0
+    dst.flush()
+    position = dst.tell()
+    copied = 0
+    try:
+        while copied < size:
+            n = os.copy_file_range(
+                src.fileno(), dst.fileno(), size - copied, offset + copied, position + copied
+            )
+            if not n:
+                raise MuxError("输入文件被截断")
+            copied += n
+    except OSError:
+        pass
+    dst.seek(position + copied)
+    return copied
+
+
+def _merge_moov(video: _Stream, audio: _Stream, partial: bool) -> bytes:
+    """合并两条流的 moov，视频轨道号为 1，音频为 2"""
+    # mvhd 最后 4 字节是 next_track_ID
+    mvhd = video.mvhd[:-4] + struct.pack(">I", 3)
+    mvex = _box(
+        b"mvex",
+        (b"" if partial else video.mehd)
+        + _set_track_id(video.trex, 1)
+        + _set_track_id(audio.trex, 2),
+    )
+    return _box(
+        b"moov",
+        mvhd
+        + _retrack(video.trak, 1, (b"tkhd",))
+        + _retrack(audio.trak, 2, (b"tkhd",))
+        + mvex
+        + b"".join(video.extra),
+    )
+
+
+@dataclass
+class InterleavePlan:
+    """
+    音视频流直接写入同一个输出文件的布局：开头是合并后的 ftyp + moov，
+    之后是两条流按时间交错的子分段，子分段原样放置
+    """
+    header: bytes
+    # 视频、音频各自的 [(源起始, 源结束（闭区间）, 输出偏移)]，按源偏移排序且首尾相连
+    extents: tuple[list[tuple[int, int, int]], list[tuple[int, int, int]]]
+    # 输出文件大小
+    size: int
+    # 输出包含的时长（秒），取两条流中较长的
+    duration: float
+
+
+def _parse_head(head: bytes) -> tuple[_Stream, SegmentIndex]:
+    """解析流开头的初始化段（ftyp + moov）和 sidx"""
+    stream = _Stream("")
+    for box_type, box in _children(head):
+        if box_type == b"ftyp":
+            stream.ftyp = box
+        elif box_type == b"moov":
+            _parse_moov(stream, box)
+    if not stream.trak:
+        raise MuxError("流开头没有 moov/trak")
+    return stream, parse_segment_index(head)
+
+
+def plan_interleave(video_head: bytes, audio_head: bytes, seconds: float = 0) -> InterleavePlan:
+    """
+    根据两条流开头的数据（至少包含到 sidx 结束）规划一次写入的合并：子分段按开始时间交错排列，
+    算出每段在输出中的位置。seconds 不为 0 时只取覆盖开头 seconds 秒的子分段，并去掉记录完整时长的 mehd
+    """
+    video, video_index = _parse_head(video_head)
+    audio, audio_index = _parse_head(audio_head)
+    header = video.ftyp + _merge_moov(video, audio, partial=bool(seconds))
+
+    items = []
+    duration = 0.0
+    for track, index in enumerate((video_index, audio_index)):
+        offset, time = index.first_offset, 0.0
+        for size, segment_duration in index.segments:
+            if seconds and time >= seconds:
+                break
+            items.append((time, track, offset, size))
+            offset += size
+            time += segment_duration
+        duration = max(duration, time)
+    items.sort(key=lambda item: (item[0], item[1]))
+
+    extents: tuple[list, list] = ([], [])
+    position = len(header)
+    for _, track, offset, size in items:
+        track_extents = extents[track]
+        if track_extents:
+            start, end, dst = track_extents[-1]
+            if end + 1 == offset and dst + end - start + 1 == position:
+                # 与上一段在源和输出中都相连，合并为一段
+                track_extents[-1] = (start, offset + size - 1, dst)
+                position += size
+                continue
+        track_extents.append((offset, offset + size - 1, position))
+        position += size
+    return InterleavePlan(header, extents, position, duration)
+
+
+def finish_interleave(path: str, plan: InterleavePlan):
+    """
+    所有子分段写入后，就地改写每个 moof 的分片序号和轨道号。盒子大小不变，
+    只读写 moof，媒体数据不再复制
+    """
+    owners = sorted(
+        (dst, track)
+        for track, track_extents in enumerate(plan.extents)
+        for _, _, dst in track_extents
+    )
+    starts = [dst for dst, _ in owners]
+    sequence = 0
+    with open(path, "r+b") as f:
+        if os.fstat(f.fileno()).st_size != plan.size:
+            raise MuxError("输出文件大小与布局不符")
+        for box in _iter_boxes(f, len(plan.header), plan.size):
+            if box.type != b"moof":
+                continue
+            track = owners[bisect.bisect_right(starts, box.offset) - 1][1]
+            f.seek(box.offset)
+            moof = f.read(box.size)
+            # 确认分片的数据偏移是相对 moof 的，绝对偏移在移动后会失效
+            _decode_time(moof)
+            sequence += 1
+            f.seek(box.offset)
+            f.write(_renumber_moof(moof, sequence, track + 1))
+    if not sequence:
+        raise MuxError("输出中没有 moof 分片")
+
+
+def remux_dash(video_path: str, audio_path: str, output_path: str, partial: bool = False):
+    """
+    在进程内把 DASH 视频流和音频流（各含一条轨道的分片 MP4）合并为一个分片 MP4：
+    合并两者的 moov，音视频分片按解码时间交错后原样复制，只改写轨道号和分片序号。
+    partial 表示输入只是开头的一部分分片，此时去掉记录完整时长的 mehd。
+    流带有 sidx 时下载会用 plan_interleave 直接写出合并结果，这里是没有索引时的后备做法，
+    每个字节要再写一次，mdat 的复制交给内核完成
+    """
+    video = _parse_stream(video_path)
+    audio = _parse_stream(audio_path)
+    moov = _merge_moov(video, audio, partial)
+
+    fragments = sorted(
+        [(frag.time, 0, frag, video) for frag in video.fragments]
+        + [(frag.time, 1, frag, audio) for frag in audio.fragments],
+        key=lambda item: (item[0], item[1]),
+    )
+
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    with (
+        open(video_path, "rb") as video_file,
+        open(audio_path, "rb") as audio_file,
+        open(output_path, "wb") as out,
+    ):
+        out.write(video.ftyp)
+        out.write(moov)
+        for sequence, (_, track_index, frag, _) in enumerate(fragments, start=1):
+            src = video_file if track_index == 0 else audio_file
+            src.seek(frag.moof.offset)
+            moof = src.read(frag.moof.size)
+            out.write(_renumber_moof(moof, sequence, track_index + 1))
+            _copy_range(src, out, frag.mdat.offset, frag.mdat.size, buffer)
+
+
+async def merge_streams(
+    video_path: str, audio_path: str, output_path: str, partial: bool = False
+):
+    """
+    合并视频流和音频流。优先在进程内重新封装；输入结构不支持时改用 ffmpeg，
+    两者都失败时抛出 MuxError
+    """
+    logger.info(f"正在合并：{output_path}")
+    try:
+        await asyncio.to_thread(remux_dash, video_path, audio_path, output_path, partial)
+        return
+    except (MuxError, struct.error, IndexError) as e:
+        logger.warning(f"进程内合并失败（{e or type(e).__name__}），改用 ffmpeg")
+    await _merge_with_ffmpeg(video_path, audio_path, output_path)
+
+
+async def _merge_with_ffmpeg(video_path: str, audio_path: str, output_path: str):
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise MuxError("无法在进程内合并，且未安装 ffmpeg")
+    command = [
+        ffmpeg, "-y", "-loglevel", "error",
+        "-i", video_path, "-i", audio_path,
+        "-c", "copy", "-f", "mp4", output_path,
+    ]
+    if platform.system() == "Windows":
+        # Windows 下默认事件循环可能不支持子进程，使用 run_in_executor
+        result = await asyncio.to_thread(
+            subprocess.run, command, capture_output=True  # noqa: ASYNC221
+        )
+        returncode, stderr = result.returncode, result.stderr
+    else:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        returncode = process.returncode
+    if returncode != 0:
+        message = stderr.decode(errors="replace").strip().splitlines()
+        raise MuxError(f"ffmpeg 退出码 {returncode}：{message[-1] if message else ''}")
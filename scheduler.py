@@ -0,0 +1,131 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Hashable
+from astrbot import logger
+from .limiter import TokenBucket
+
+
+class QueueFull(Exception):
+    """下载队列已满"""
+
+
+class DownloadScheduler:
+    """
+    全局下载调度器：限制同时进行的下载数，超出的任务进入有上限的等待队列，
+    空出名额时在各群/会话之间轮流分配，一个群连续点播不会饿死其他群。
+    可选的总带宽上限由所有下载共用一个令牌桶实现
+    """
+    def __init__(
+        self,
+        max_concurrent: int = 2,
+        max_queue: int = 20,
+        bandwidth_limit: int = 0,
+    ):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max_queue
+        # 总带宽上限（字节/秒），下载器按块取令牌；为 None 时不限速
+        self.limiter = (
+            TokenBucket(bandwidth_limit, capacity=bandwidth_limit)
+            if bandwidth_limit > 0
+            else None
+        )
+        self._running = 0
+        # 各群的等待队列，按轮转顺序排列：下一个获得名额的是第一个群的第一个任务
+        self._queues: OrderedDict[Hashable, deque[asyncio.Future]] = OrderedDict()
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _position(self, group: Hashable, future: asyncio.Future) -> int:
+        """按轮转顺序计算任务前面还有几个等待的任务"""
+        index = self._queues[group].index(future)
+        ahead = 0
+        before = True
+        for other, queue in self._queues.items():
+            if other == group:
+                before = False
+                ahead += index
+            else:
+                # 前 index 轮中每轮都排在前面，第 index 轮只有轮转顺序靠前的群排在前面
+                ahead += min(len(queue), index + 1 if before else index)
+        return ahead
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        group: Hashable,
+        notify: Callable[[int], Awaitable] | None = None,
+    ):
+        """
+        获取一个下载名额，退出时释放。需要排队时调用 notify(前面的任务数) 告知用户，
+        队列已满时抛出 QueueFull
+        """
+        if self._running < self.max_concurrent and not self._queues:
+            self._running += 1
+        else:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(f"下载队列已满（{self.max_queue}）")
+            future = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(group, deque()).append(future)
+            position = self._position(group, future)
+            logger.info(f"下载任务排队：{group}，前面还有 {position} 个任务")
+            # 发送提示也可能被取消，和等待名额放在同一个 try 中，保证排队的 future 被清理
+            try:
+                if notify is not None:
+                    try:
+                        await notify(position)
+                    except Exception as e:
+                        logger.warning(f"发送排队提示失败: {e}")
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # 名额已分配但任务被取消，转交给下一个任务
+                    self._release()
+                else:
+                    self._discard(group, future)
+                raise
+        try:
+            yield
+        finally:
+            self.completed += 1
+            self._release()
+
+    def _discard(self, group: Hashable, future: asyncio.Future):
+        queue = self._queues.get(group)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[group]
+
+    def _release(self):
+        """释放名额，按轮转顺序交给下一个等待的任务"""
+        while self._queues:
+            group, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(group)
+            else:
+                del self._queues[group]
+            if not future.done():
+                # 名额直接转交，运行数不变
+                future.set_result(None)
+                return
+        self._running -= 1
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "queued": self.queued,
+            "groups_waiting": len(self._queues),
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
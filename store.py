@@ -0,0 +1,233 @@
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+from astrbot import logger
+from .downloader import remove_stale_partials
+
+# 插件保存的视频文件名：{bvid}-{画质}.mp4
+VIDEO_FILE_PATTERN = re.compile(r"^(BV[0-9A-Za-z]+)-([0-9A-Za-z]+)\.mp4$")
+
+
+class VideoStore:
+    """
+    带磁盘配额的视频库：用 SQLite 记录已保存的视频及其使用情况，
+    在后台按最近访问时间淘汰超出配额或过期的视频
+    """
+    def __init__(
+        self,
+        root: Path,
+        quota: int = 2 * 1024 * 1024 * 1024,
+        max_age: float = 7 * 24 * 3600,
+        evict_interval: float = 600,
+        in_use: Callable[[str], bool] = lambda path: False,
+    ):
+        self.root = root
+        self.quota = quota
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        # 判断文件是否正在被发送，正在使用的文件不会被淘汰
+        self.in_use = in_use
+        self.lookups = 0
+        self.hits = 0
+        # 登记的视频数和占用字节，随登记、淘汰和清理索引更新，统计时不必查询数据库
+        self.entries = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._evict_task: asyncio.Task | None = None
+        # 关闭后不再打开数据库或启动淘汰任务；之后登记的视频在下次打开时由目录扫描补登记
+        self._closed = False
+
+    def path_for(self, bvid: str, quality: str) -> str:
+        return str(self.root / f"{bvid}-{quality}.mp4")
+
+    def _db(self) -> sqlite3.Connection:
+        """打开数据库，首次打开时把目录中尚未登记的视频补登记"""
+        if self._conn is None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.root / "videos.db", check_same_thread=False)
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS videos (
+                    bvid TEXT NOT NULL,
+                    quality TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    duration INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (bvid, quality)
+                )
+                """
+            )
+            for entry in os.scandir(self.root):
+                match = VIDEO_FILE_PATTERN.match(entry.name)
+                if not match or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                conn.execute(
+                    "INSERT OR IGNORE INTO videos "
+                    "(bvid, quality, path, size, created, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (*match.groups(), entry.path, stat.st_size, stat.st_mtime, stat.st_mtime),
+                )
+            conn.commit()
+            self.entries, self.bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM videos"
+            ).fetchone()
+            self._conn = conn
+        return self._conn
+
+    def _ensure_evicting(self):
+        if self._evict_task is None and not self._closed:
+            self._evict_task = asyncio.create_task(self._evict_loop())
+
+    async def lookup(self, bvid: str, quality: str) -> str | None:
+        """查找已保存的视频，命中时更新访问时间"""
+        self._ensure_evicting()
+        return await asyncio.to_thread(self._lookup, bvid, quality)
+
+    def _lookup(self, bvid: str, quality: str) -> str | None:
+        with self._lock:
+            if self._closed:
+                return None
+            db = self._db()
+            self.lookups += 1
+            row = db.execute(
+                "SELECT path, size FROM videos WHERE bvid = ? AND quality = ?",
+                (bvid, quality),
+            ).fetchone()
+            if row is None:
+                return None
+            path, size = row
+            try:
+                valid = os.path.getsize(path) == size
+            except OSError:
+                valid = False
+            if not valid:
+                # 文件被外部删除或改动，清理索引
+                db.execute(
+                    "DELETE FROM videos WHERE bvid = ? AND quality = ?", (bvid, quality)
+                )
+                db.commit()
+                self.entries -= 1
+                self.bytes -= size
+                return None
+            db.execute(
+                "UPDATE videos SET last_access = ?, hits = hits + 1 "
+                "WHERE bvid = ? AND quality = ?",
+                (time.time(), bvid, quality),
+            )
+            db.commit()
+            self.hits += 1
+            return path
+
+    async def add(self, bvid: str, quality: str, path: str, duration: int = 0):
+        """登记一个已完成的视频"""
+        self._ensure_evicting()
+        await asyncio.to_thread(self._add, bvid, quality, path, duration)
+
+    def _add(self, bvid: str, quality: str, path: str, duration: int):
+        size = os.path.getsize(path)
+        now = time.time()
+        with self._lock:
+            if self._closed:
+                return
+            db = self._db()
+            old = db.execute(
+                "SELECT size FROM videos WHERE bvid = ? AND quality = ?", (bvid, quality)
+            ).fetchone()
+            db.execute(
+                "INSERT OR REPLACE INTO videos "
+                "(bvid, quality, path, size, duration, created, last_access, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                (bvid, quality, path, size, duration, now, now),
+            )
+            db.commit()
+            if old is None:
+                self.entries += 1
+            else:
+                self.bytes -= old[0]
+            self.bytes += size
+
+    async def evict(self) -> int:
+        """淘汰过期和超出配额的视频，返回删除的数量"""
+        return await asyncio.to_thread(self._evict)
+
+    def _evict(self) -> int:
+        with self._lock:
+            if self._closed:
+                return 0
+            db = self._db()
+            rows = db.execute(
+                "SELECT bvid, quality, path, size, last_access FROM videos "
+                "ORDER BY last_access"
+            ).fetchall()
+            total = sum(row[3] for row in rows)
+            expire_before = time.time() - self.max_age
+            remove_stale_partials(self.root)
+            removed = 0
+            for bvid, quality, path, size, last_access in rows:
+                if total <= self.quota and last_access >= expire_before:
+                    break
+                if self.in_use(path):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"删除缓存视频失败 {path}: {e}")
+                    continue
+                db.execute(
+                    "DELETE FROM videos WHERE bvid = ? AND quality = ?", (bvid, quality)
+                )
+                total -= size
+                removed += 1
+            db.commit()
+            self.entries -= removed
+            self.bytes = total
+            if removed:
+                logger.info(f"视频库已淘汰 {removed} 个视频，当前占用 {total / 1024 / 1024:.1f}MB")
+            return removed
+
+    async def _evict_loop(self):
+        while True:
+            try:
+                await self.evict()
+            except Exception as e:
+                logger.error(f"视频库淘汰失败: {e}")
+            await asyncio.sleep(self.evict_interval)
+
+    def stats(self) -> dict:
+        """视频库统计：条目数、占用字节、命中率。读取计数器，不访问数据库，库首次使用前条目数为 0"""
+        return {
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "quota": self.quota,
+            **self.hit_stats(),
+        }
+
+    def hit_stats(self) -> dict:
+        """查询命中率，不访问数据库"""
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+        }
+
+    async def close(self):
+        self._closed = True
+        if self._evict_task is not None:
+            self._evict_task.cancel()
+            self._evict_task = None
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,110 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Awaitable, Callable
+from astrbot import logger
+
+if TYPE_CHECKING:
+    from bilibili_api.video import AudioStreamDownloadURL, VideoStreamDownloadURL
+
+# 同一画质下的编码优先级（VideoCodecs 成员名），与 detect_best_streams 的默认顺序一致
+CODEC_PRIORITY = ["AV1", "AVC", "HEV"]
+
+# 按码率估算的体积超过预算的这个比例时，再用实际文件大小核对
+PROBE_THRESHOLD = 0.8
+
+# 最多核对几组音视频流的实际大小，避免选流本身耗时过长
+MAX_PROBES = 4
+
+
+@dataclass
+class StreamChoice:
+    """选中的音视频流"""
+    video: "VideoStreamDownloadURL"
+    audio: "AudioStreamDownloadURL"
+    # 预计的下载体积（字节），按码率估算或取自实际文件大小
+    size: int
+    # size 是否为实际文件大小
+    exact: bool = False
+
+
+def _codec_rank(stream: "VideoStreamDownloadURL") -> int:
+    try:
+        return CODEC_PRIORITY.index(stream.video_codecs.name)
+    except ValueError:
+        return len(CODEC_PRIORITY)
+
+
+def estimate_size(bandwidth: int, duration: float) -> int:
+    """按平均码率（bit/s）和时长估算流的体积，未知时返回 0"""
+    if bandwidth <= 0 or duration <= 0:
+        return 0
+    return int(bandwidth * duration / 8)
+
+
+async def select_streams(
+    streams: list,
+    duration: float,
+    budget: int = 0,
+    probe: Callable[[str], Awaitable[int | None]] | None = None,
+) -> StreamChoice | None:
+    """
+    从 VideoDownloadURLDataDetecter.detect() 的结果中选出体积不超过 budget 字节的最佳音视频组合：
+    画质从高到低、同画质按编码优先级、音质从高到低依次尝试，第一组放得下的即为结果。
+    体积按码率 × 时长估算，估算值接近预算或无法估算时调用 probe 取实际大小核对。
+    budget 为 0 表示不限制；所有组合都超出预算时返回体积最小的组合
+    """
+    from bilibili_api.video import AudioStreamDownloadURL, VideoStreamDownloadURL
+
+    videos = sorted(
+        (s for s in streams if isinstance(s, VideoStreamDownloadURL)),
+        key=lambda s: (-s.video_quality.value, _codec_rank(s), s.bandwidth),
+    )
+    audios = sorted(
+        (s for s in streams if isinstance(s, AudioStreamDownloadURL)),
+        key=lambda s: (-s.bandwidth, -s.audio_quality.value),
+    )
+    if not videos or not audios:
+        return None
+
+    probed: dict[str, int | None] = {}
+    probes = 0
+
+    async def actual_size(stream) -> int | None:
+        nonlocal probes
+        if stream.url not in probed:
+            probes += 1
+            probed[stream.url] = await probe(stream.url)
+        return probed[stream.url]
+
+    smallest: StreamChoice | None = None
+    for video_stream in videos:
+        for audio_stream in audios:
+            choice = StreamChoice(
+                video_stream,
+                audio_stream,
+                estimate_size(video_stream.bandwidth, duration)
+                + estimate_size(audio_stream.bandwidth, duration),
+            )
+            if not budget:
+                return choice
+            uncertain = (
+                not video_stream.bandwidth
+                or not audio_stream.bandwidth
+                or duration <= 0
+                or choice.size > budget * PROBE_THRESHOLD
+            )
+            if uncertain and probe is not None and probes < MAX_PROBES:
+                video_size = await actual_size(video_stream)
+                audio_size = await actual_size(audio_stream)
+                if video_size is not None and audio_size is not None:
+                    choice.size = video_size + audio_size
+                    choice.exact = True
+            if choice.size <= budget:
+                return choice
+            if smallest is None or choice.size < smallest.size:
+                smallest = choice
+
+    logger.warning(
+        f"所有音视频流都超出体积预算 {budget / 1024 / 1024:.0f}MB，"
+        f"使用最小的组合（约 {smallest.size / 1024 / 1024:.1f}MB）"
+    )
+    return smallest
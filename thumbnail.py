@@ -0,0 +1,169 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from typing import TYPE_CHECKING
+from astrbot import logger
+from .cache import TTLCache
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+class ThumbnailCache:
+    """
+    两级封面缓存：内存中缓存已缩放好的图片，磁盘上缓存缩放后的 JPEG，
+    磁盘层有容量上限和最长保存时间，超出时按最近使用时间淘汰
+    """
+    def __init__(
+        self,
+        cache_dir: Path,
+        size: tuple[int, int],
+        memory_items: int = 256,
+        disk_quota: int = 64 * 1024 * 1024,
+        max_age: float = 7 * 24 * 3600,
+        quality: int = 90,
+    ):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.disk_quota = disk_quota
+        self.max_age = max_age
+        self.quality = quality
+        self.memory = TTLCache(memory_items, ttl=None)
+        # 磁盘索引：文件名 -> (文件大小, 最近访问时间)，按访问时间排序
+        self._disk_index: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        self._disk_bytes = 0
+        self._disk_loaded = False
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _key(self, url: str) -> str:
+        # 文件名中带上尺寸，修改卡片尺寸后旧缓存自然失效
+        width, height = self.size
+        digest = hashlib.md5(url.encode()).hexdigest()
+        return f"{digest}_{width}x{height}.jpg"
+
+    async def get(self, url: str) -> "Image.Image | None":
+        """按 URL 取缩放好的封面，未命中返回 None"""
+        key = self._key(url)
+        image = self.memory.get(key)
+        if image is not None:
+            return image
+        image = await asyncio.to_thread(self._load_from_disk, key)
+        if image is not None:
+            self.memory.set(key, image)
+        return image
+
+    async def put(self, url: str, data: bytes) -> "Image.Image":
+        """解码并缩放原图，写入两级缓存，返回缩放后的图片"""
+        key = self._key(url)
+        image = await asyncio.to_thread(self._store, key, data)
+        self.memory.set(key, image)
+        return image
+
+    def _load_index(self):
+        """首次访问磁盘层时扫描缓存目录，同时清理过期文件"""
+        if self._disk_loaded:
+            return
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.endswith(".tmp") or now - stat.st_mtime > self.max_age:
+                self._remove(entry.name)
+                continue
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, name, size in sorted(entries):
+            self._disk_index[name] = (size, mtime)
+            self._disk_bytes += size
+        self._disk_loaded = True
+        self._evict()
+
+    def _load_from_disk(self, key: str) -> "Image.Image | None":
+        from PIL import Image
+
+        with self._lock:
+            self._load_index()
+            item = self._disk_index.get(key)
+            if item is None:
+                return None
+            size, accessed_at = item
+            path = self.cache_dir / key
+            if time.time() - accessed_at > self.max_age:
+                self._drop(key)
+                return None
+            try:
+                image = Image.open(path)
+                image.load()
+            except OSError as e:
+                logger.warning(f"封面缓存损坏，已删除 {path}: {e}")
+                self._drop(key)
+                return None
+            # 更新访问时间，mtime 用作重启后的 LRU 顺序
+            now = time.time()
+            self._disk_index[key] = (size, now)
+            self._disk_index.move_to_end(key)
+            os.utime(path, (now, now))
+            self.disk_hits += 1
+            return image
+
+    def _store(self, key: str, data: bytes) -> "Image.Image":
+        from PIL import Image
+
+        image = Image.open(BytesIO(data)).convert("RGB")
+        if image.size != self.size:
+            image = image.resize(self.size, Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", quality=self.quality)
+        encoded = buffer.getvalue()
+
+        with self._lock:
+            self._load_index()
+            path = self.cache_dir / key
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(encoded)
+            os.replace(tmp_path, path)
+            if key in self._disk_index:
+                self._disk_bytes -= self._disk_index[key][0]
+            self._disk_index[key] = (len(encoded), time.time())
+            self._disk_index.move_to_end(key)
+            self._disk_bytes += len(encoded)
+            self._evict()
+        return image
+
+    def _evict(self):
+        """超出容量或超过最长保存时间的文件按 LRU 顺序删除"""
+        now = time.time()
+        while self._disk_index:
+            key, (size, accessed_at) = next(iter(self._disk_index.items()))
+            if self._disk_bytes <= self.disk_quota and now - accessed_at <= self.max_age:
+                break
+            self._drop(key)
+
+    def _drop(self, key: str):
+        size, _ = self._disk_index.pop(key)
+        self._disk_bytes -= size
+        self._remove(key)
+
+    def _remove(self, name: str):
+        try:
+            os.remove(self.cache_dir / name)
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        """缓存统计"""
+        return {
+            "memory": self.memory.stats(),
+            "disk_entries": len(self._disk_index),
+            "disk_bytes": self._disk_bytes,
+            "disk_hits": self.disk_hits,
+        }